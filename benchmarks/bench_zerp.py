@@ -0,0 +1,484 @@
+#!/usr/bin/python
+
+""" Benchmarks for izaber.plpython.zerp
+
+    Builds a synthetic Zerp schema (product_uom, product_template,
+    product_product, nested set stock_location, stock_warehouse and
+    stock_move) in a scratch PostgreSQL database, installs the plpython
+    functions into it and times:
+
+        - trigger overhead per stock_move write for each trigger mode
+        - sync_product_product_summary throughput
+        - get_products_available latency by batch size
+        - vacuum duration, both in one go and in batches
+
+    The results themselves are checked by check_zerp.py on the same
+    dataset.
+
+    The database needs plpython3u with izaber.plpython.zerp importable by
+    the server's python. EVERYTHING IN IT GETS DROPPED so never point this
+    at a real database.
+
+        python benchmarks/bench_zerp.py --dsn "dbname=zerp_bench" \\
+                --products 10000 --moves 1000000 --output results.json
+
+    Requires psycopg 3
+"""
+
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+
+import psycopg
+
+TRIGGER_MODES = ( 'row', 'statement', 'incremental' )
+BATCH_SIZES = ( 1, 10, 100, 1000 )
+
+# ( category_id, factor, rounding ) of the synthetic UoMs. The first of
+# each category is its reference unit
+UOMS = [
+    ( 1, 1, 1 ),        # Unit
+    ( 1, 1/12, 1 ),     # Dozen
+    ( 2, 1, 0.001 ),    # kg
+    ( 2, 1000, 1 ),     # g
+    ( 3, 1, 0.01 ),     # m
+    ( 3, 100, 1 ),      # cm
+]
+
+# Share of stock moves per state
+MOVE_STATES = [
+    ( 'done', 0.70 ),
+    ( 'confirmed', 0.08 ),
+    ( 'waiting', 0.04 ),
+    ( 'assigned', 0.08 ),
+    ( 'draft', 0.05 ),
+    ( 'cancel', 0.05 ),
+]
+
+SCHEMA = """
+DROP TABLE IF EXISTS
+    stock_move,
+    stock_warehouse,
+    stock_location,
+    product_product,
+    product_template,
+    product_uom,
+    zerp_product_summary,
+    zerp_product_dirty_log,
+    zerp_product_dirty_queue,
+    zerp_product_location_qty,
+    zerp_product_qty_checkpoint,
+    zerp_plpy_state
+CASCADE;
+
+CREATE TABLE product_uom (
+    id serial primary key,
+    category_id integer not null,
+    factor numeric not null,
+    rounding numeric not null
+);
+
+CREATE TABLE product_template (
+    id serial primary key,
+    uom_id integer references product_uom
+);
+
+CREATE TABLE product_product (
+    id serial primary key,
+    product_tmpl_id integer references product_template
+);
+
+CREATE TABLE stock_location (
+    id integer primary key,
+    location_id integer references stock_location,
+    active boolean not null default true,
+    parent_left integer,
+    parent_right integer
+);
+
+CREATE TABLE stock_warehouse (
+    id serial primary key,
+    lot_stock_id integer references stock_location
+);
+
+CREATE TABLE stock_move (
+    id serial primary key,
+    product_id integer references product_product,
+    product_uom integer references product_uom,
+    product_qty numeric,
+    location_id integer not null references stock_location,
+    location_dest_id integer not null references stock_location,
+    state varchar(16),
+    date timestamp not null
+);
+"""
+
+INSTALL_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION fn_zerp_bench_install(mode text, keep_history boolean)
+RETURNS TEXT AS
+$$
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    return iplpy.install(stock_move_trigger_mode=mode, keep_history=keep_history)
+$$
+LANGUAGE plpython3u;
+
+CREATE OR REPLACE FUNCTION fn_zerp_bench_products_available(ids integer[])
+RETURNS INTEGER AS
+$$
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    return len(iplpy.get_products_available(ids))
+$$
+LANGUAGE plpython3u;
+
+CREATE OR REPLACE FUNCTION fn_zerp_bench_version()
+RETURNS TEXT AS
+$$
+    import izaber.plpython.zerp
+    return izaber.plpython.zerp.__version__
+$$
+LANGUAGE plpython3u;
+"""
+
+def log(message, *args):
+    sys.stderr.write(message.format(*args) + "\n")
+    sys.stderr.flush()
+
+def build_locations(warehouses, bins):
+    """ Returns the rows ( id, parent_id, parent_left, parent_right ) of
+        a location tree along with the stock location id of each
+        warehouse and the ids of the supplier, customer and inventory
+        loss locations
+    """
+    children = {}
+    next_id = [0]
+
+    def add(parent_id):
+        next_id[0] += 1
+        children.setdefault(parent_id, []).append(next_id[0])
+        return next_id[0]
+
+    root = add(None)
+    physical = add(root)
+    stock_ids = []
+    for i in range(warehouses):
+        warehouse_root = add(physical)
+        stock_id = add(warehouse_root)
+        stock_ids.append(stock_id)
+        for j in range(bins):
+            add(stock_id)
+        add(warehouse_root)     # Output, outside of the stock subtree
+    partners = add(root)
+    supplier = add(partners)
+    customer = add(partners)
+    virtual = add(root)
+    inventory = add(virtual)
+
+    rows = []
+    counter = [0]
+    def visit(location_id, parent_id):
+        counter[0] += 1
+        parent_left = counter[0]
+        for child_id in children.get(location_id, []):
+            visit(child_id, location_id)
+        counter[0] += 1
+        rows.append(( location_id, parent_id, parent_left, counter[0] ))
+    visit(root, None)
+    rows.sort()
+
+    return rows, stock_ids, {
+        'supplier': supplier,
+        'customer': customer,
+        'inventory': inventory,
+    }
+
+def build_dataset(conn, args):
+    log("Building schema")
+    conn.execute("SELECT setseed(%s)", [1.0 / (abs(args.seed) + 1)])
+    conn.execute(SCHEMA)
+
+    with conn.cursor() as cur:
+        cur.executemany(
+            "INSERT INTO product_uom (category_id, factor, rounding) VALUES (%s, %s, %s)",
+            UOMS
+        )
+
+    reference_uoms = [
+        uom_id
+        for uom_id, ( category_id, factor, rounding ) in enumerate(UOMS, 1)
+        if factor == 1
+    ]
+
+    log("Creating {} products", args.products)
+    conn.execute("""
+        INSERT INTO product_template (uom_id)
+        SELECT (%(uoms)s::int[])[1 + g %% %(uom_count)s]
+        FROM generate_series(1, %(products)s) g
+    """, {
+        'uoms': reference_uoms,
+        'uom_count': len(reference_uoms),
+        'products': args.products,
+    })
+    conn.execute("""
+        INSERT INTO product_product (product_tmpl_id)
+        SELECT id FROM product_template ORDER BY id
+    """)
+
+    locations, stock_ids, partners = build_locations(args.warehouses, args.bins)
+    with conn.cursor() as cur:
+        cur.executemany(
+            "INSERT INTO stock_location (id, location_id, parent_left, parent_right) VALUES (%s, %s, %s, %s)",
+            locations
+        )
+        cur.executemany(
+            "INSERT INTO stock_warehouse (lot_stock_id) VALUES (%s)",
+            [ ( stock_id, ) for stock_id in stock_ids ]
+        )
+
+    internal_ids = [
+        location[0] for location in locations
+        if any(
+            stock_left <= location[2] < stock_right
+            for stock_id, parent_id, stock_left, stock_right in locations
+            if stock_id in stock_ids
+        )
+    ]
+
+    log("Creating {} stock moves", args.moves)
+    states = []
+    for state, share in MOVE_STATES:
+        states += [ state ] * int(share * 100)
+
+    # Moves are generated server side. Each picks a kind of move, then
+    # locations to match: receipts, deliveries, internal transfers and
+    # inventory adjustments
+    conn.execute("""
+        INSERT INTO stock_move
+            (product_id, product_uom, product_qty, location_id, location_dest_id, state, date)
+        SELECT
+            m.product_id,
+            CASE
+                WHEN random() < 0.9 THEN pt.uom_id
+                ELSE pt.uom_id + 1
+            END,
+            round((1 + random() * 99)::numeric, 2),
+            CASE m.kind
+                WHEN 0 THEN %(supplier)s
+                WHEN 3 THEN %(inventory)s
+                ELSE m.internal_a
+            END,
+            CASE m.kind
+                WHEN 1 THEN %(customer)s
+                WHEN 2 THEN m.internal_b
+                ELSE m.internal_a
+            END,
+            m.state,
+            now() - random() * interval '730 days'
+        FROM (
+            SELECT
+                1 + floor(random() * %(products)s)::int product_id,
+                floor(random() * 4)::int kind,
+                (%(internal)s::int[])[1 + floor(random() * %(internal_count)s)::int] internal_a,
+                (%(internal)s::int[])[1 + floor(random() * %(internal_count)s)::int] internal_b,
+                (%(states)s::text[])[1 + floor(random() * %(state_count)s)::int] state
+            FROM generate_series(1, %(moves)s) g
+        ) m
+        JOIN product_product pp ON pp.id = m.product_id
+        JOIN product_template pt ON pt.id = pp.product_tmpl_id
+    """, {
+        'supplier': partners['supplier'],
+        'customer': partners['customer'],
+        'inventory': partners['inventory'],
+        'internal': internal_ids,
+        'internal_count': len(internal_ids),
+        'states': states,
+        'state_count': len(states),
+        'products': args.products,
+        'moves': args.moves,
+    })
+    conn.execute("ANALYZE")
+    conn.commit()
+
+def install(conn, mode, keep_history=False):
+    conn.execute(INSTALL_FUNCTIONS)
+    conn.execute("SELECT fn_zerp_bench_install(%s, %s)", [mode, keep_history])
+    conn.commit()
+
+def timed(conn, query, params=None):
+    start = time.perf_counter()
+    conn.execute(query, params)
+    return time.perf_counter() - start
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+def bench_trigger_overhead(conn, args, rnd):
+    """ Times single row stock_move updates and one bulk update with the
+        triggers of each mode installed and with all triggers disabled
+    """
+    max_id = conn.execute("SELECT max(id) FROM stock_move").fetchone()[0]
+    move_ids = [ rnd.randint(1, max_id) for i in range(args.trigger_writes) ]
+    bulk_ids = [ rnd.randint(1, max_id) for i in range(args.bulk_size) ]
+
+    def run(disable_triggers):
+        if disable_triggers:
+            conn.execute("ALTER TABLE stock_move DISABLE TRIGGER USER")
+        samples = [
+            timed(conn, "UPDATE stock_move SET product_qty = product_qty + 1 WHERE id = %s", [move_id])
+            for move_id in move_ids
+        ]
+        bulk = timed(
+            conn,
+            "UPDATE stock_move SET product_qty = product_qty + 1 WHERE id = ANY(%s)",
+            [bulk_ids]
+        )
+        conn.rollback()
+        return {
+            'single_row': summarize(samples),
+            'bulk_rows': len(bulk_ids),
+            'bulk_ms': bulk * 1000,
+        }
+
+    results = { 'no_triggers': run(True) }
+    for mode in args.trigger_modes:
+        log("Trigger overhead ({})", mode)
+        install(conn, mode)
+        results[mode] = run(False)
+    install(conn, 'row')
+    return results
+
+def bench_sync(conn, args):
+    """ Flags every product dirty and times a full sync
+    """
+    log("Sync throughput")
+    conn.execute("UPDATE zerp_product_summary SET dirty = true")
+    conn.commit()
+    elapsed = timed(conn, "SELECT fn_sync_product_product_summary()")
+    conn.commit()
+    return {
+        'products': args.products,
+        'seconds': elapsed,
+        'products_per_second': args.products / elapsed if elapsed else None,
+    }
+
+def bench_products_available(conn, args, rnd):
+    results = {}
+    for batch_size in args.batch_sizes:
+        log("get_products_available latency (batch of {})", batch_size)
+        samples = []
+        for i in range(args.latency_repeats):
+            ids = [ rnd.randint(1, args.products) for j in range(batch_size) ]
+            samples.append(timed(
+                conn,
+                "SELECT fn_zerp_bench_products_available(%s::int[])",
+                [ids]
+            ))
+        conn.rollback()
+        results[str(batch_size)] = summarize(samples)
+    return results
+
+def bench_vacuum(conn, args):
+    """ Builds up history with repeated full syncs and times cleaning it
+        up both in a single statement and in batches
+    """
+    install(conn, 'row', keep_history=True)
+
+    def build_history():
+        for i in range(args.history_rounds):
+            conn.execute("UPDATE zerp_product_summary SET dirty = true")
+            conn.execute("SELECT fn_sync_product_product_summary()")
+            conn.commit()
+        return conn.execute("SELECT count(*) FROM zerp_product_dirty_log").fetchone()[0]
+
+    results = {}
+    for name, batch_size in [ ( 'single', 0 ), ( 'batched', args.vacuum_batch_size ) ]:
+        log("Vacuum ({})", name)
+        rows = build_history()
+        elapsed = timed(
+            conn,
+            "SELECT fn_zerp_plpy_vacuum(%s, 0)",
+            [batch_size]
+        )
+        conn.commit()
+        results[name] = {
+            'log_rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed else None,
+        }
+
+    install(conn, 'row', keep_history=False)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1].strip())
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of a SCRATCH database')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--moves', type=int, default=1000000)
+    parser.add_argument('--warehouses', type=int, default=3)
+    parser.add_argument('--bins', type=int, default=50,
+                        help='locations under each warehouse stock location')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-build', action='store_true',
+                        help='reuse the dataset from a previous run')
+    parser.add_argument('--trigger-modes', nargs='+', default=list(TRIGGER_MODES))
+    parser.add_argument('--trigger-writes', type=int, default=500)
+    parser.add_argument('--bulk-size', type=int, default=5000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=list(BATCH_SIZES))
+    parser.add_argument('--latency-repeats', type=int, default=20)
+    parser.add_argument('--history-rounds', type=int, default=3)
+    parser.add_argument('--vacuum-batch-size', type=int, default=10000)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    conn = psycopg.connect(args.dsn)
+
+    if not args.skip_build:
+        build_dataset(conn, args)
+
+    start = time.perf_counter()
+    log("Installing")
+    install(conn, 'row')
+    install_seconds = time.perf_counter() - start
+
+    results = {
+        'version': conn.execute("SELECT fn_zerp_bench_version()").fetchone()[0],
+        'server_version': conn.execute("SHOW server_version").fetchone()[0],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': {
+            'products': args.products,
+            'moves': args.moves,
+            'warehouses': args.warehouses,
+            'bins': args.bins,
+            'seed': args.seed,
+        },
+        'install_seconds': install_seconds,
+        'trigger_overhead': bench_trigger_overhead(conn, args, rnd),
+        'sync': bench_sync(conn, args),
+        'get_products_available': bench_products_available(conn, args, rnd),
+        'vacuum': bench_vacuum(conn, args),
+    }
+    conn.commit()
+    conn.close()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+""" Consistency checks for izaber.plpython.zerp
+
+    Uses the synthetic Zerp schema of bench_zerp.py and checks that:
+
+        - the row, statement and incremental trigger modes leave the same
+          quantities in zerp_product_summary after the same stock_move
+          writes
+        - get_products_available gives the same results with the 'sql'
+          and 'python' UoM conversions
+        - fn_zerp_plpy_audit finds no drift after a full sync
+
+    Exits with a non zero status if any of them fail. Like the benchmarks
+    EVERYTHING IN THE DATABASE GETS DROPPED so never point this at a real
+    database.
+
+        python benchmarks/check_zerp.py --dsn "dbname=zerp_bench"
+
+    Requires psycopg 3
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import psycopg
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_zerp import TRIGGER_MODES, log, build_dataset, install
+
+CHECK_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION fn_zerp_check_uom_modes(ids integer[])
+RETURNS INTEGER[] AS
+$$
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    by_sql = iplpy.get_products_available(ids, uom_convert_mode='sql')
+    by_python = iplpy.get_products_available(ids, uom_convert_mode='python')
+    return sorted(
+        product_id
+        for product_id in set(by_sql) | set(by_python)
+        if by_sql.get(product_id) != by_python.get(product_id)
+    )
+$$
+LANGUAGE plpython3u;
+"""
+
+SUMMARY_COLUMNS = (
+    'dirty',
+    'cached_qty_available',
+    'cached_virtual_available',
+    'cached_incoming_qty',
+    'cached_outgoing_qty',
+)
+
+def build_writes(conn, args, rnd):
+    """ Returns a list of ( query, params ) stock_move writes covering
+        each kind of change the triggers have to deal with. The moves
+        are picked from the dataset as it was built so the same list can
+        be replayed after each restore
+    """
+    max_move_id = conn.execute("SELECT max(id) FROM stock_move").fetchone()[0]
+    location_ids = [
+        row[0] for row in conn.execute("SELECT id FROM stock_location ORDER BY id")
+    ]
+    states = [ 'draft', 'confirmed', 'waiting', 'assigned', 'done', 'cancel' ]
+
+    def move_id():
+        return rnd.randint(1, max_move_id)
+
+    writes = []
+    for i in range(args.writes):
+        kind = rnd.randrange(8)
+        if kind == 0:
+            writes.append((
+                "UPDATE stock_move SET product_qty = product_qty + %s WHERE id = %s",
+                [ rnd.randint(1, 50), move_id() ]
+            ))
+        elif kind == 1:
+            writes.append((
+                "UPDATE stock_move SET state = %s WHERE id = %s",
+                [ rnd.choice(states), move_id() ]
+            ))
+        elif kind == 2:
+            writes.append((
+                "UPDATE stock_move SET location_dest_id = %s WHERE id = %s",
+                [ rnd.choice(location_ids), move_id() ]
+            ))
+        elif kind == 3:
+            # Another product, in its own UoM so the conversion still works
+            writes.append(("""
+                UPDATE  stock_move m
+                SET     product_id = pp.id,
+                        product_uom = pt.uom_id
+                FROM    product_product pp
+                JOIN    product_template pt ON pt.id = pp.product_tmpl_id
+                WHERE   pp.id = %s
+                    AND m.id = %s
+            """, [ rnd.randint(1, args.products), move_id() ]))
+        elif kind == 4:
+            # Between the product's UoM and the next one of the category
+            writes.append(("""
+                UPDATE  stock_move m
+                SET     product_uom = pt.uom_id + %s
+                FROM    product_product pp
+                JOIN    product_template pt ON pt.id = pp.product_tmpl_id
+                WHERE   pp.id = m.product_id
+                    AND m.id = %s
+            """, [ rnd.randint(0, 1), move_id() ]))
+        elif kind == 5:
+            writes.append(("""
+                INSERT INTO stock_move
+                    (product_id, product_uom, product_qty, location_id, location_dest_id, state, date)
+                SELECT
+                    product_id, product_uom, %s, location_id, location_dest_id, state, now()
+                FROM stock_move
+                WHERE id = %s
+            """, [ rnd.randint(1, 100), move_id() ]))
+        elif kind == 6:
+            writes.append((
+                "DELETE FROM stock_move WHERE id = %s",
+                [ move_id() ]
+            ))
+        else:
+            writes.append((
+                "UPDATE stock_move SET product_qty = product_qty * 2 WHERE id = ANY(%s)",
+                [ [ move_id() for j in range(args.bulk_size) ] ]
+            ))
+    return writes
+
+def restore_moves(conn):
+    """ Puts stock_move back the way it was built without going through
+        the triggers
+    """
+    conn.execute("ALTER TABLE stock_move DISABLE TRIGGER USER")
+    conn.execute("DELETE FROM stock_move")
+    conn.execute("INSERT INTO stock_move SELECT * FROM zerp_check_stock_move")
+    conn.execute("SELECT setval('stock_move_id_seq', (SELECT max(id) FROM stock_move))")
+    conn.execute("ALTER TABLE stock_move ENABLE TRIGGER USER")
+    conn.commit()
+
+def full_sync(conn):
+    conn.execute("UPDATE zerp_product_summary SET dirty = true")
+    conn.execute("SELECT fn_sync_product_product_summary()")
+    conn.commit()
+
+def audit(conn):
+    """ Returns the ids of the products fn_zerp_plpy_audit finds drifted
+        in a pass over all of them
+    """
+    conn.execute("DELETE FROM zerp_plpy_state WHERE name = 'audit:last_id'")
+    drifted = conn.execute("SELECT drifted_products FROM fn_zerp_plpy_audit(0)").fetchone()[0]
+    conn.commit()
+    return drifted or []
+
+def summary(conn):
+    return dict(
+        ( row[0], row[1:] )
+        for row in conn.execute("""
+            SELECT product_id, {columns}
+            FROM zerp_product_summary
+            ORDER BY product_id
+        """.format(columns=", ".join(SUMMARY_COLUMNS)))
+    )
+
+def check_trigger_modes(conn, args, writes):
+    """ Replays the writes under each trigger mode and compares the
+        summaries they leave behind
+    """
+    failures = []
+    summaries = {}
+    for mode in args.trigger_modes:
+        log("Trigger mode {}", mode)
+        restore_moves(conn)
+        install(conn, mode)
+        full_sync(conn)
+        for query, params in writes:
+            conn.execute(query, params)
+            conn.commit()
+        conn.execute("SELECT fn_sync_product_product_summary()")
+        conn.commit()
+        summaries[mode] = summary(conn)
+
+        drifted = audit(conn)
+        if drifted:
+            failures.append("{} mode: {} product(s) drifted, e.g. {}".format(
+                mode, len(drifted), drifted[:10]
+            ))
+
+    reference_mode = args.trigger_modes[0]
+    reference = summaries[reference_mode]
+    for mode in args.trigger_modes[1:]:
+        differing = sorted(
+            product_id
+            for product_id in set(reference) | set(summaries[mode])
+            if reference.get(product_id) != summaries[mode].get(product_id)
+        )
+        if differing:
+            failures.append("{} and {} modes differ on {} product(s), e.g. {}".format(
+                reference_mode, mode, len(differing), differing[:10]
+            ))
+
+    install(conn, 'row')
+    return failures
+
+def check_uom_modes(conn, args):
+    log("UoM conversion modes")
+    product_ids = [
+        row[0] for row in conn.execute("SELECT id FROM product_product ORDER BY id")
+    ]
+    differing = []
+    for i in range(0, len(product_ids), args.batch_size):
+        differing += conn.execute(
+            "SELECT fn_zerp_check_uom_modes(%s::int[])",
+            [ product_ids[i:i+args.batch_size] ]
+        ).fetchone()[0]
+    conn.rollback()
+    if differing:
+        return [ "sql and python UoM conversions differ on {} product(s), e.g. {}".format(
+            len(differing), differing[:10]
+        ) ]
+    return []
+
+def check_audit(conn):
+    log("Audit after a full sync")
+    full_sync(conn)
+    drifted = audit(conn)
+    if drifted:
+        return [ "audit found {} drifted product(s) after a full sync, e.g. {}".format(
+            len(drifted), drifted[:10]
+        ) ]
+    return []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1].strip())
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of a SCRATCH database')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--moves', type=int, default=50000)
+    parser.add_argument('--warehouses', type=int, default=3)
+    parser.add_argument('--bins', type=int, default=10,
+                        help='locations under each warehouse stock location')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-build', action='store_true',
+                        help='reuse the dataset from a previous run')
+    parser.add_argument('--trigger-modes', nargs='+', default=list(TRIGGER_MODES))
+    parser.add_argument('--writes', type=int, default=500,
+                        help='stock_move writes replayed under each trigger mode')
+    parser.add_argument('--bulk-size', type=int, default=100,
+                        help='moves changed by each bulk write')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='products per UoM conversion comparison')
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    conn = psycopg.connect(args.dsn)
+
+    # The moves as built, for restoring between trigger modes
+    if not args.skip_build:
+        build_dataset(conn, args)
+        conn.execute("DROP TABLE IF EXISTS zerp_check_stock_move")
+    conn.execute("CREATE TABLE IF NOT EXISTS zerp_check_stock_move AS SELECT * FROM stock_move")
+    conn.commit()
+
+    log("Installing")
+    install(conn, 'row')
+    conn.execute(CHECK_FUNCTIONS)
+    conn.commit()
+
+    writes = build_writes(conn, args, rnd)
+
+    failures = []
+    failures += check_trigger_modes(conn, args, writes)
+    failures += check_uom_modes(conn, args)
+    failures += check_audit(conn)
+
+    conn.close()
+
+    for failure in failures:
+        log("FAIL: {}", failure)
+    if failures:
+        sys.exit(1)
+    log("OK")
+
+if __name__ == '__main__':
+    main()
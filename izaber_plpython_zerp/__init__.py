@@ -1,4 +1,5 @@
 import os
+import time
 
 from izaber import config, app_config, autoloader
 from izaber.startup import request_initialize, initializer
@@ -7,6 +8,7 @@ from izaber.log import log
 import importlib
 import izaber.plpython
 
+import izaber.plpython.zerp.base
 from izaber.plpython.zerp.base import IPLPY
 
 __version__ = '1.0'
@@ -14,22 +16,65 @@ __version__ = '1.0'
 CONFIG_BASE = """
 """
 
-def reload_base():
+# With GD['always_reload'] set, seconds between checks of whether base.py
+# changed on disk
+RELOAD_CHECK_INTERVAL = 2.0
+
+def base_signature():
+    """ Identifies the base.py on disk so we can tell when it's been
+        edited or reinstalled
+    """
+    try:
+        stat = os.stat(izaber.plpython.zerp.base.__file__)
+    except OSError:
+        return None
+    return ( stat.st_mtime, stat.st_size )
+
+BASE_SIGNATURE = base_signature()
+
+def reload_base(GD=None):
+    """ Reloads base.py and returns its IPLPY. The plans in GD prepared
+        by the previous version of the module may no longer match the
+        queries it issues so they're dropped
+    """
+    global BASE_SIGNATURE
     izaber.plpython.reload_base()
     importlib.reload(izaber.plpython.zerp.base)
+    BASE_SIGNATURE = base_signature()
+    if GD is not None:
+        GD.pop('plan_cache',None)
     from izaber.plpython.zerp.base import IPLPY
     return IPLPY
 
+def base_changed(GD):
+    """ Returns True if base.py changed since it was loaded. Only looks
+        at the file once per RELOAD_CHECK_INTERVAL
+    """
+    now = time.monotonic()
+    if now < GD.get('reload_checked',0) + RELOAD_CHECK_INTERVAL:
+        return False
+    GD['reload_checked'] = now
+    return base_signature() != BASE_SIGNATURE
+
 def init_plpy(plpy_globals,reload=False):
+    """ Returns the IPLPY for this backend. The instance is created once
+        and kept in GD, later calls only hand it the new call's globals
+    """
     global IPLPY
 
-    plpy = plpy_globals['plpy']
+    GD = plpy_globals['GD']
 
-    if reload or plpy_globals['GD'].get('always_reload'):
+    if reload or GD.get('always_reload') and base_changed(GD):
         plpy_globals['plpy'].debug(
             "Reloading izaber.plpython.zerp.base"
         )
-        IPLPY = reload_base()
-    return IPLPY(plpy_globals)
+        IPLPY = reload_base(GD)
 
+    # An instance of the class from before a reload gets replaced
+    iplpy = GD.get('iplpy')
+    if iplpy is None or type(iplpy) is not IPLPY:
+        iplpy = GD['iplpy'] = IPLPY(plpy_globals)
+    else:
+        iplpy.configure(**plpy_globals)
+    return iplpy
 
@@ -0,0 +1,219 @@
+""" Runs IPLPY outside of the database
+
+    Provides just enough of the plpy module on top of a psycopg 3
+    connection for IPLPY to work from a regular python process. That
+    allows profiling with the usual tools and spreading heavy recomputes
+    over a pool of processes (see izaber.plpython.zerp.sync_client)
+
+        import psycopg
+        from izaber.plpython.zerp.adapter import connect_iplpy
+
+        iplpy = connect_iplpy(psycopg.connect("dbname=zerp"))
+        print(iplpy.get_products_available([1633]))
+
+    Requires psycopg 3 (pip install izaber-plpython-zerp[daemon])
+"""
+
+import itertools
+import logging
+
+from izaber.plpython.zerp.base import IPLPY
+
+log = logging.getLogger('izaber.plpython.zerp.adapter')
+
+# Names of the prepared statements need to be unique per connection
+PLAN_NAMES = itertools.count(1)
+
+# First keywords of the statements PREPARE accepts
+PREPARABLE_KEYWORDS = ( 'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES', 'MERGE' )
+
+class PlpyResult(list):
+    """ List of row hashes like the result of plpy.execute
+    """
+
+    def __init__(self, rows, rowcount, colnames):
+        super(PlpyResult, self).__init__(rows)
+        self._nrows = rowcount
+        self._colnames = colnames
+
+    def nrows(self):
+        return self._nrows
+
+    def colnames(self):
+        return self._colnames
+
+class PlpyPlan(object):
+    """ A statement prepared on the server with PREPARE. Those PREPARE
+        can't take are kept with a name of None and run directly
+    """
+
+    def __init__(self, name, query, types):
+        self.name = name
+        self.query = query
+        self.types = list(types)
+
+    def execute_sql(self):
+        """ The EXECUTE statement with a placeholder for each argument
+        """
+        if not self.types:
+            return "EXECUTE {}".format(self.name)
+        return "EXECUTE {}({})".format(
+                    self.name,
+                    ", ".join( "%s" for t in self.types )
+                )
+
+class PlpyCursor(object):
+    """ Like the cursors returned by plpy.cursor. Note that the rows are
+        pulled over in one go and only handed out in batches by fetch
+    """
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def fetch(self, count):
+        if self.cur.closed:
+            return PlpyResult([], 0, [])
+        rows = self.cur.fetchmany(count)
+        return PlpyResult(rows, len(rows), self.colnames())
+
+    def colnames(self):
+        if not self.cur.description:
+            return []
+        return [ column.name for column in self.cur.description ]
+
+    def close(self):
+        self.cur.close()
+
+    def __iter__(self):
+        return iter(self.cur)
+
+class PlpyAdapter(object):
+    """ Stands in for the plpy module. Plans are prepared on the server
+        once per distinct query and kept for the life of the connection,
+        the way PL/Python keeps the ones saved in GD
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = {}
+
+        # Called after every commit and rollback. See connect_iplpy
+        self.transaction_end_callbacks = []
+
+    def cursor_factory(self):
+        # Arguments are bound client side as EXECUTE doesn't accept
+        # parameters through the extended query protocol
+        import psycopg
+        from psycopg.rows import dict_row
+        return psycopg.ClientCursor(self.conn, row_factory=dict_row)
+
+    def prepare(self, query, types=[]):
+        key = ( query, tuple(types) )
+        plan = self.plans.get(key)
+        if plan is None:
+            # PREPARE only takes SELECT, INSERT, UPDATE, DELETE, MERGE
+            # and VALUES. Anything else (LOCK, CREATE, ...) and statements
+            # without parameters are sent as is each time they're run
+            words = query.split(None, 1)
+            keyword = words[0].upper() if words else ''
+            if types and keyword in PREPARABLE_KEYWORDS:
+                plan = PlpyPlan(
+                            'zerp_plpy_{}'.format(next(PLAN_NAMES)),
+                            query,
+                            types
+                        )
+                sql = "PREPARE {} ({}) AS {}".format(
+                            plan.name, ", ".join(plan.types), query
+                        )
+                with self.cursor_factory() as cur:
+                    cur.execute(sql)
+            else:
+                plan = PlpyPlan(None, query, types)
+            self.plans[key] = plan
+        return plan
+
+    def run(self, plan_or_query, args=[]):
+        cur = self.cursor_factory()
+        if isinstance(plan_or_query, PlpyPlan):
+            if plan_or_query.name is not None:
+                cur.execute(plan_or_query.execute_sql(), list(args))
+            elif args:
+                cur.close()
+                raise Exception("Only SELECT, INSERT, UPDATE, DELETE, MERGE and VALUES take arguments")
+            else:
+                cur.execute(plan_or_query.query)
+        else:
+            cur.execute(plan_or_query)
+        return cur
+
+    def execute(self, plan_or_query, args=[], limit=None):
+        with self.run(plan_or_query, args) as cur:
+            if cur.description is None:
+                return PlpyResult([], cur.rowcount, [])
+            if limit:
+                rows = cur.fetchmany(limit)
+            else:
+                rows = cur.fetchall()
+            colnames = [ column.name for column in cur.description ]
+            return PlpyResult(rows, cur.rowcount, colnames)
+
+    def cursor(self, plan_or_query, args=[]):
+        return PlpyCursor(self.run(plan_or_query, args))
+
+    def commit(self):
+        self.conn.commit()
+        self.transaction_ended()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.transaction_ended()
+
+    def transaction_ended(self):
+        for callback in self.transaction_end_callbacks:
+            callback()
+
+    def debug(self, *args):
+        log.debug(*args)
+
+    def log(self, *args):
+        log.info(*args)
+
+    def info(self, *args):
+        log.info(*args)
+
+    def notice(self, *args):
+        log.info(*args)
+
+    def warning(self, *args):
+        log.warning(*args)
+
+    def error(self, *args):
+        raise Exception(*args)
+
+    def fatal(self, *args):
+        raise Exception(*args)
+
+def connect_iplpy(conn, GD=None):
+    """ Returns an IPLPY working over the psycopg connection conn. GD
+        takes the place of PL/Python's per backend dict. As it holds
+        the prepared plans, it can only be shared between instances using
+        the same connection
+
+        Inside the database each call starts with fresh lookups of the
+        cache generations and settings. Here the instance lives on so
+        they're forgotten whenever the transaction ends through
+        iplpy.plpy.commit() or rollback(). Code committing on conn
+        directly should call iplpy.reset_call_state() afterwards
+    """
+    if GD is None:
+        GD = {}
+    plpy = PlpyAdapter(conn)
+    plpy_globals = {
+        'plpy': plpy,
+        'GD': GD,
+        'SD': {},
+        'TD': None,
+    }
+    iplpy = IPLPY(plpy_globals)
+    plpy.transaction_end_callbacks.append(iplpy.reset_call_state)
+    return iplpy
@@ -1,8 +1,205 @@
+import bisect
+import collections
+import decimal
+import functools
 import pprint
+import time
 
 import izaber.plpython.base
 
+# Ways in which stock_move changes can be tracked. See
+# IPLPY.install_stock_move_triggers
+STOCK_MOVE_TRIGGER_MODES = ( 'row', 'statement', 'incremental' )
+
+# Every trigger that might have been installed on stock_move by us
+STOCK_MOVE_TRIGGERS = (
+    'trig_stock_move_qty_changes_update',
+    'trig_stock_move_qty_changes_insdel',
+    'trig_stock_move_qty_changes_stmt_insert',
+    'trig_stock_move_qty_changes_stmt_update',
+    'trig_stock_move_qty_changes_stmt_delete',
+    'trig_stock_move_qty_delta_update',
+    'trig_stock_move_qty_delta_insdel',
+)
+
+# Triggers on stock_move keeping zerp_product_location_qty up to date.
+# See IPLPY.install_location_matrix
+LOCATION_MATRIX_TRIGGERS = (
+    'trig_stock_move_location_matrix_insert',
+    'trig_stock_move_location_matrix_update',
+    'trig_stock_move_location_matrix_delete',
+)
+
+# The stock_move columns that have an effect on product quantities
+STOCK_MOVE_QTY_COLUMNS = (
+    'product_uom',
+    'product_qty',
+    'location_id',
+    'location_dest_id',
+    'product_id',
+    'state',
+)
+
+# Only stock moves in these states count towards product quantities
+STOCK_MOVE_QTY_STATES = ( 'confirmed', 'waiting', 'assigned', 'done' )
+
+# Defaults for IPLPY.vacuum so that a plain fn_zerp_plpy_vacuum() only
+# does a bounded amount of work
+VACUUM_BATCH_SIZE = 10000
+VACUUM_MAX_SECONDS = 30
+
+# Channel mark_products_dirty notifies on when dirty notifications are
+# turned on. The payload is a comma separated list of product ids kept
+# under the NOTIFY payload limit
+NOTIFY_CHANNEL = 'zerp_product_dirty'
+NOTIFY_MAX_PAYLOAD = 7900
+
+# Batch sizing for IPLPY.sync_dirty_products. Batches start at
+# SYNC_INITIAL_BATCH_SIZE products and are resized to take around
+# SYNC_TARGET_BATCH_SECONDS each. Progress is reported at most once every
+# SYNC_PROGRESS_INTERVAL seconds
+SYNC_INITIAL_BATCH_SIZE = 100
+SYNC_MIN_BATCH_SIZE = 10
+SYNC_MAX_BATCH_SIZE = 5000
+SYNC_TARGET_BATCH_SECONDS = 0.5
+SYNC_PROGRESS_INTERVAL = 5
+
+# Defaults for IPLPY.audit_drift. The product ids are compared in ranges
+# of AUDIT_RANGE_SIZE ids, AUDIT_CHUNK_RANGES ranges per query. Ranges
+# that differ are halved until they're down to AUDIT_LEAF_SIZE ids which
+# are then compared product by product. The checksums weight each
+# product's quantities by product_id % AUDIT_CHECKSUM_MODULUS + 1 so that
+# errors in different products don't cancel each other out
+AUDIT_MAX_SECONDS = 30
+AUDIT_RANGE_SIZE = 1000
+AUDIT_CHUNK_RANGES = 20
+AUDIT_LEAF_SIZE = 50
+AUDIT_CHECKSUM_MODULUS = 7919
+
+# Number of products iter_products_available calculates at a time
+PRODUCTS_AVAILABLE_BATCH_SIZE = 500
+
+# Number of products get_cached_products_available keeps in its per
+# backend LRU
+CACHED_PRODUCTS_LRU_SIZE = 10000
+
+# Columns of zerp_product_summary returned by get_cached_products_available
+# and the keys they're returned under
+CACHED_QUANTITY_COLUMNS = (
+    ( 'cached_qty_available', 'qty_available' ),
+    ( 'cached_virtual_available', 'virtual_available' ),
+    ( 'cached_incoming_qty', 'incoming_qty' ),
+    ( 'cached_outgoing_qty', 'outgoing_qty' ),
+)
+
+# SQL expressions used by get_products_available to take the summed
+# quantity of a group of stock moves (c) into the product's UoM (via the
+# product template pt). The 'sql' version mirrors IPLPY.uom_convert with
+# the from (fu) and to (tu) product_uom rows joined in, handing anything
+# it can't convert to the python version so the same errors get raised.
+# Halves are rounded to even like python's round() does
+UOM_CONVERT_EXPRESSIONS = {
+    'sql': """
+            CASE
+                WHEN    c.product_uom IS NULL
+                     OR pt.uom_id IS NULL
+                     OR c.product_uom = pt.uom_id
+                     OR c.product_qty = 0
+                    THEN c.product_qty
+                WHEN    fu.category_id <> tu.category_id
+                     OR fu.id IS NULL
+                     OR tu.id IS NULL
+                    THEN fn_uom_convert(c.product_uom,c.product_qty,pt.uom_id)
+                WHEN    COALESCE(tu.rounding,0) = 0
+                    THEN c.product_qty / fu.factor * tu.factor
+                ELSE
+                    fn_zerp_round_half_even(c.product_qty / fu.factor * tu.factor / tu.rounding) * tu.rounding
+            END
+    """,
+    'python': """
+            fn_uom_convert(c.product_uom,c.product_qty,pt.uom_id)
+    """,
+}
+UOM_CONVERT_MODES = tuple(UOM_CONVERT_EXPRESSIONS)
+
+
+# Positions of the values recorded per name by instrumented. Kept as a
+# list rather than a hash to keep the overhead down
+STAT_CALLS, STAT_TOTAL_TIME, STAT_MAX_TIME, STAT_QUERIES, STAT_ROWS = range(5)
+
+def instrumented(method):
+    """ Decorator for IPLPY methods that records their call count, wall
+        time and the queries they issue in GD['stats']. Queries are
+        attributed to the innermost instrumented method running
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        entry = self.stats_entry(name)
+        stack = self.GD.get('stats_stack')
+        if stack is None:
+            stack = self.GD['stats_stack'] = []
+        stack.append(entry)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            entry[STAT_CALLS] += 1
+            entry[STAT_TOTAL_TIME] += elapsed
+            if elapsed > entry[STAT_MAX_TIME]:
+                entry[STAT_MAX_TIME] = elapsed
+
+    return wrapper
+
+class StockLocations(object):
+    """ The internal stock.location ids of all warehouses. Each warehouse
+        contributes the nested set subtree rooted at its lot_stock_id
+
+        locations is a list of ( location_id, warehouse_id ). The ids are
+        kept sorted so that membership tests are a binary search
+    """
+
+    def __init__(self, generation, locations):
+        self.generation = generation
+        self.ids = sorted(set( location[0] for location in locations ))
+        self.warehouse_ids = {}
+        for location_id, warehouse_id in locations:
+            self.warehouse_ids[location_id] = warehouse_id
+
+    def __contains__(self, location_id):
+        i = bisect.bisect_left(self.ids, location_id)
+        return i < len(self.ids) and self.ids[i] == location_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def warehouse_id(self, location_id):
+        """ Returns the warehouse the location belongs to or None
+        """
+        return self.warehouse_ids.get(location_id)
+
+
 class IPLPY(izaber.plpython.base.IPLPY):
+    def configure(self, **kwargs):
+        super(IPLPY, self).configure(**kwargs)
+        self.reset_call_state()
+
+    def reset_call_state(self):
+        """ Forgets the cache generations and settings already looked up
+            during this call. Anything running across several transactions
+            needs to call this after each commit so changes made in the
+            meantime get picked up
+        """
+        self.generations_seen = {}
+        self.settings_seen = {}
+        self.state_seen = None
+
     def info(self, *args):
         self.plpy.info(*args)
 
@@ -11,29 +208,335 @@ class IPLPY(izaber.plpython.base.IPLPY):
             return f
         return round(f / r) * r
 
+    def plan(self, name, query, types=[]):
+        """ Returns the prepared plan for the statement known as `name`,
+            preparing it on first use. Plans are kept per backend in GD
+            so each statement is only parsed and planned once
+        """
+        plans = self.GD.setdefault('plan_cache',{})
+        stats = self.GD.setdefault('plan_cache_stats',{'hits':0,'misses':0})
+        plan = plans.get(name)
+        if plan is None:
+            stats['misses'] += 1
+            plan = self.plpy.prepare(query,types)
+            plans[name] = plan
+        else:
+            stats['hits'] += 1
+        return plan
+
+    def q(self, query, types=[], args=[]):
+        result = super(IPLPY, self).q(query,types,args)
+        self.count_query(result)
+        return result
+
+    def qp(self, name, query, types=[], args=[]):
+        """ Like q but goes through the prepared plan cache
+        """
+        result = self.plpy.execute(self.plan(name,query,types),args)
+        self.count_query(result)
+        return result
+
+    def reset_plan_cache(self):
+        """ Drops all cached plans and zeros the hit/miss counters
+        """
+        self.GD['plan_cache'] = {}
+        self.GD['plan_cache_stats'] = {'hits':0,'misses':0}
+
+    def plan_cache_stats(self):
+        """ Returns a hash of the plan cache hits, misses and the number
+            of plans currently held
+        """
+        stats = self.GD.setdefault('plan_cache_stats',{'hits':0,'misses':0})
+        return {
+            'hits': stats['hits'],
+            'misses': stats['misses'],
+            'plans': len(self.GD.get('plan_cache',{})),
+        }
+
+    def stats_entry(self, name):
+        """ Returns the list of values recorded for `name` in this
+            backend (see instrumented)
+        """
+        stats = self.GD.get('stats')
+        if stats is None:
+            stats = self.GD['stats'] = {}
+        entry = stats.get(name)
+        if entry is None:
+            entry = stats[name] = [ 0, 0.0, 0.0, 0, 0 ]
+        return entry
+
+    def count_event(self, name, count=1):
+        """ Counts occurrences of things like cache hits that aren't
+            worth timing
+        """
+        self.stats_entry(name)[STAT_CALLS] += count
+
+    def count_query(self, result):
+        """ Attributes a query and the rows it returned to the
+            instrumented method currently running
+        """
+        stack = self.GD.get('stats_stack')
+        if stack:
+            entry = stack[-1]
+            entry[STAT_QUERIES] += 1
+            entry[STAT_ROWS] += len(result)
+
+    def stats(self):
+        """ Returns a list of hashes with what's been recorded in this
+            backend since the last reset_stats
+        """
+        results = []
+        for name, entry in sorted(self.GD.get('stats',{}).items()):
+            results.append({
+                'name': name,
+                'calls': entry[STAT_CALLS],
+                'total_ms': entry[STAT_TOTAL_TIME] * 1000,
+                'max_ms': entry[STAT_MAX_TIME] * 1000,
+                'avg_ms': entry[STAT_CALLS] and entry[STAT_TOTAL_TIME] * 1000 / entry[STAT_CALLS] or 0,
+                'queries': entry[STAT_QUERIES],
+                'rows': entry[STAT_ROWS],
+            })
+        plan_cache_stats = self.plan_cache_stats()
+        for key in ( 'hits', 'misses' ):
+            results.append({
+                'name': 'plan_cache.'+key,
+                'calls': plan_cache_stats[key],
+                'total_ms': 0,
+                'max_ms': 0,
+                'avg_ms': 0,
+                'queries': 0,
+                'rows': 0,
+            })
+        return results
+
+    def reset_stats(self):
+        self.GD['stats'] = {}
+        self.GD['plan_cache_stats'] = {'hits':0,'misses':0}
+
+    def cache_generation(self, name):
+        """ Returns the current generation number of the cache `name`.
+            Anything that changes the data behind a cache bumps its
+            generation with bump_cache_generation, which lets every
+            backend notice that its copy is stale. The lookup is only
+            done once per call
+        """
+        if name not in self.generations_seen:
+            self.generations_seen[name] = self.shared_state().get('generation:'+name, 0)
+        return self.generations_seen[name]
+
+    def shared_state(self):
+        """ Returns a hash of everything in zerp_plpy_state. It's read in
+            a single query the first time it's needed in a call so the
+            triggers pay for one lookup no matter how many settings and
+            generations they go through
+        """
+        if self.state_seen is None:
+            data = self.qp('shared_state', """
+                SELECT  name, value
+                FROM    zerp_plpy_state
+            """)
+            self.state_seen = dict( ( row['name'], row['value'] ) for row in data )
+        return self.state_seen
+
+    def get_state(self, name, default=0):
+        """ Returns the value stored under `name` in zerp_plpy_state
+        """
+        data = self.qp('get_state', """
+            SELECT  value
+            FROM    zerp_plpy_state
+            WHERE   name = $1
+        """,["text"],[name])
+        if not data:
+            return default
+        return data[0]['value']
+
+    def set_state(self, name, value):
+        """ Stores value under `name` in zerp_plpy_state
+        """
+        self.qp('set_state', """
+            INSERT INTO zerp_plpy_state
+                    ( name, value, update_time )
+            VALUES  ( $1, $2, now() )
+            ON CONFLICT ( name ) DO UPDATE
+            SET     value = EXCLUDED.value,
+                    update_time = now()
+        """,["text","bigint"],[name, value])
+        return value
+
+    def get_setting(self, name, default=0):
+        """ Like get_state for values that rarely change. The lookup is
+            only done once per call
+        """
+        if name not in self.settings_seen:
+            self.settings_seen[name] = self.shared_state().get('setting:'+name, default)
+        return self.settings_seen[name]
+
+    def set_setting(self, name, value):
+        self.settings_seen[name] = value
+        return self.set_state('setting:'+name, value)
+
+    def bump_cache_generation(self, name):
+        """ Invalidates the cache `name` in all backends
+        """
+        data = self.qp('bump_cache_generation', """
+            INSERT INTO zerp_plpy_state
+                    ( name, value, update_time )
+            VALUES  ( $1, 1, now() )
+            ON CONFLICT ( name ) DO UPDATE
+            SET     value = zerp_plpy_state.value + 1,
+                    update_time = now()
+            RETURNING value
+        """,["text"],['generation:'+name])
+        self.generations_seen[name] = data[0]['value']
+        return self.generations_seen[name]
+
     def table_exists(self, table_name):
         """ Returns True/False depending on if the table exists
         """
-        result = self.q("""
+        result = self.qp('table_exists', """
             SELECT EXISTS (
                 SELECT 1
                 FROM pg_tables
                 WHERE schemaname = 'public'
-                AND tablename = '{table_name}'
+                AND tablename = $1
+            );
+        """,["text"],[table_name])
+        return result[0]['exists']
+
+    def trigger_exists(self, table_name, trigger_name):
+        """ Returns True/False depending on if the table has the trigger
+        """
+        result = self.qp('trigger_exists', """
+            SELECT EXISTS (
+                SELECT 1
+                FROM pg_trigger t
+                JOIN pg_class c ON c.oid = t.tgrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'public'
+                AND c.relname = $1
+                AND t.tgname = $2
+                AND NOT t.tgisinternal
             );
-        """.format(table_name=table_name))
+        """,["text","text"],[table_name, trigger_name])
         return result[0]['exists']
 
-    def install(self):
+    def install(self, stock_move_trigger_mode=None, keep_history=None, notify_dirty=None, coalesce_dirty=None, location_matrix=None):
         """ Sets up the requisite tables and such in the database
+
+            stock_move_trigger_mode selects how stock_move changes are
+            tracked:
+
+                'row'       - one trigger call per modified stock_move row
+                'statement' - one trigger call per DML statement, using
+                              transition tables to find the products
+                'incremental' - one trigger call per modified stock_move
+                              row that applies the row's change directly
+                              to the cached quantities rather than
+                              flagging the product for a full recompute
+
+            The current state of each product lives in zerp_product_summary.
+            With keep_history every change to it is also appended to
+            zerp_product_dirty_log (see install_history)
+
+            With notify_dirty, products that become dirty are announced on
+            the NOTIFY_CHANNEL for the sync daemon to pick up
+
+            With coalesce_dirty, products are only flagged as dirty once
+            per transaction when it commits (see install_dirty_coalescing)
+
+            With location_matrix, the quantity of each product in each
+            location is also maintained (see install_location_matrix)
+
+            Any option left as None keeps what the previous install set
+            up ('row' and off for a first install)
         """
-        if not self.table_exists('zerp_product_dirty_log'):
+        # get_products_available falls back onto this for conversions
+        # that can't be done in SQL
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_uom_convert(from_uom_id integer,qty numeric,to_uom_id integer)
+            RETURNS NUMERIC AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.uom_convert(from_uom_id,qty,to_uom_id)
+            $$
+            LANGUAGE plpython3u;
+        """)
 
-            # Ensure our base table is present
+        # SQL's ROUND takes halves away from zero, python's round() takes
+        # them to the even neighbour. The 'sql' UoM conversion uses this
+        # so both modes agree
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_round_half_even(value numeric)
+            RETURNS NUMERIC AS
+            $$
+                SELECT
+                    CASE
+                        WHEN value - FLOOR(value) = 0.5
+                            THEN FLOOR(value) + ABS(MOD(FLOOR(value), 2))
+                        ELSE ROUND(value)
+                    END
+            $$
+            LANGUAGE sql IMMUTABLE;
+        """)
+
+        # Small key/value store for state shared between the backends
+        # such as cache generations
+        self.q("""
+            CREATE TABLE IF NOT EXISTS zerp_plpy_state (
+                  name text primary key,
+                  value bigint not null default 0,
+                  update_time timestamp not null default now()
+            )
+        """)
+
+        # Anything not given keeps what's installed now
+        if stock_move_trigger_mode is None:
+            mode_index = self.get_setting('stock_move_trigger_mode', None)
+            if mode_index is not None:
+                stock_move_trigger_mode = STOCK_MOVE_TRIGGER_MODES[mode_index]
+            # Installed before the mode was recorded
+            elif self.trigger_exists('stock_move', 'trig_stock_move_qty_changes_stmt_insert'):
+                stock_move_trigger_mode = 'statement'
+            elif self.trigger_exists('stock_move', 'trig_stock_move_qty_delta_update'):
+                stock_move_trigger_mode = 'incremental'
+            else:
+                stock_move_trigger_mode = 'row'
+        if keep_history is None:
+            keep_history = self.get_setting('keep_history', None)
+            if keep_history is None:
+                keep_history = self.trigger_exists(
+                                    'zerp_product_summary',
+                                    'trig_zerp_product_summary_history'
+                                )
+        if notify_dirty is None:
+            notify_dirty = self.get_setting('notify_dirty')
+        if coalesce_dirty is None:
+            coalesce_dirty = self.get_setting('coalesce_dirty')
+        if location_matrix is None:
+            location_matrix = self.get_setting('location_matrix')
+
+        # Known quantities of products at points in time which lets us
+        # answer historical queries without going through all the moves
+        self.q("""
+            CREATE TABLE IF NOT EXISTS zerp_product_qty_checkpoint (
+                  product_id integer not null,
+                  checkpoint_time timestamp not null,
+                  qty_available numeric not null,
+                  virtual_available numeric not null,
+                  incoming_qty numeric not null,
+                  outgoing_qty numeric not null,
+                  primary key ( product_id, checkpoint_time )
+            )
+        """)
+
+        if not self.table_exists('zerp_product_summary'):
+
+            # Ensure our base table is present. This holds the current
+            # state of each product
             self.q("""
-                CREATE TABLE IF NOT EXISTS zerp_product_dirty_log (
-                      id serial primary key,
-                      product_id integer not null,
+                CREATE TABLE IF NOT EXISTS zerp_product_summary (
+                      product_id integer primary key,
                       update_time timestamp not null,
                       dirty boolean not null,
                       cached_qty_available numeric,
@@ -43,9 +546,33 @@ class IPLPY(izaber.plpython.base.IPLPY):
                 )
             """)
 
+            # Carry over what we already know from the log used by older
+            # versions
+            if self.table_exists('zerp_product_dirty_log'):
+                self.q("""
+                    INSERT INTO zerp_product_summary
+                            (
+                                product_id, update_time, dirty,
+                                cached_qty_available,
+                                cached_virtual_available,
+                                cached_incoming_qty,
+                                cached_outgoing_qty
+                            )
+                    SELECT DISTINCT ON (product_id)
+                            product_id, update_time, dirty,
+                            cached_qty_available,
+                            cached_virtual_available,
+                            cached_incoming_qty,
+                            cached_outgoing_qty
+                    FROM
+                            zerp_product_dirty_log
+                    ORDER BY
+                            product_id, update_time desc, dirty desc, id desc
+                """)
+
             # Ensure we've got some data
             self.q("""
-                INSERT INTO zerp_product_dirty_log
+                INSERT INTO zerp_product_summary
                         (
                             product_id, update_time, dirty,
                             cached_qty_available,
@@ -57,84 +584,1105 @@ class IPLPY(izaber.plpython.base.IPLPY):
                         id, now(), True,
                         0, 0, 0, 0
                 FROM
-                        product_product;
+                        product_product
+                ON CONFLICT ( product_id ) DO NOTHING
             """)
 
-            # Setup the index that allows fast lookup for the latest
-            # entries
+            # Setup the index that allows fast lookup for the entries
+            # that need recalculating
             self.q("""
-                CREATE INDEX ndx_zerp_product_dirty_log_update
-                ON           zerp_product_dirty_log
-                            ( product_id, update_time desc, dirty desc );
+                CREATE INDEX ndx_zerp_product_summary_dirty
+                ON           zerp_product_summary ( product_id )
+                WHERE        dirty
             """)
 
             # Request that the quantities be recalculated now
             self.sync_product_product_summary();
 
-            # Provide methods to tell the system to sync up data
+        self.install_history(keep_history)
+        self.install_dirty_coalescing(coalesce_dirty)
+        self.set_setting('notify_dirty', notify_dirty and 1 or 0)
+
+        # Provide methods to tell the system to sync up data
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_sync_product_product_summary()
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.sync_product_product_summary()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_sync_product_product_summary(ids integer[])
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.sync_product_product_summary(ids)
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Bounded runs for working through a large backlog in short
+        # transactions
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_sync_product_product_summary_budget(
+                max_seconds float8 default null,
+                max_products integer default null,
+                ids integer[] default null
+            )
+            RETURNS TABLE (
+                processed integer,
+                remaining bigint,
+                seconds float8,
+                rate float8
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return [ iplpy.sync_dirty_products(ids, max_seconds, max_products) ]
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Read access to the stored quantities
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_cached_products_available(
+                ids integer[],
+                max_age float8 default 0
+            )
+            RETURNS TABLE (
+                product_id integer,
+                update_time timestamp,
+                dirty boolean,
+                qty_available numeric,
+                virtual_available numeric,
+                incoming_qty numeric,
+                outgoing_qty numeric
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return list(iplpy.get_cached_products_available(ids, max_age).values())
+            $$
+            LANGUAGE plpython3u;
+        """)
+        for function_name, key in [
+                    ( 'fn_get_cached_available_qty', 'qty_available' ),
+                    ( 'fn_get_cached_virtual_available', 'virtual_available' ),
+                    ( 'fn_get_cached_incoming_qty', 'incoming_qty' ),
+                    ( 'fn_get_cached_outgoing_qty', 'outgoing_qty' ),
+                ]:
+            self.q("""
+                CREATE OR REPLACE FUNCTION {function_name}(product_id integer)
+                RETURNS NUMERIC AS
+                $$
+                    from izaber.plpython.zerp import init_plpy
+                    iplpy = init_plpy(globals())
+                    results = iplpy.get_cached_products_available([product_id])
+                    return results.get(product_id,{{}}).get('{key}')
+                $$
+                LANGUAGE plpython3u;
+            """.format(
+                function_name=function_name,
+                key=key
+            ))
+
+        # Read access that recalculates anything out of date first
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_fresh_products_available(
+                ids integer[],
+                max_staleness float8 default null
+            )
+            RETURNS TABLE (
+                product_id integer,
+                update_time timestamp,
+                dirty boolean,
+                qty_available numeric,
+                virtual_available numeric,
+                incoming_qty numeric,
+                outgoing_qty numeric
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return list(iplpy.get_fresh_products_available(ids, max_staleness).values())
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Typed, streamed versions of get_products_available
+        self.q("""
+            DO $$
+            BEGIN
+                CREATE TYPE zerp_product_quantities AS (
+                    product_id integer,
+                    qty_available numeric,
+                    virtual_available numeric,
+                    incoming_qty numeric,
+                    outgoing_qty numeric
+                );
+            EXCEPTION
+                WHEN duplicate_object THEN NULL;
+            END
+            $$
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_products_available(
+                ids integer[],
+                batch_size integer default {batch_size}
+            )
+            RETURNS SETOF zerp_product_quantities AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.iter_products_available(ids, batch_size)
+            $$
+            LANGUAGE plpython3u;
+        """.format(batch_size=PRODUCTS_AVAILABLE_BATCH_SIZE))
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_all_products_available(
+                batch_size integer default {batch_size}
+            )
+            RETURNS SETOF zerp_product_quantities AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.iter_products_available(None, batch_size)
+            $$
+            LANGUAGE plpython3u;
+        """.format(batch_size=PRODUCTS_AVAILABLE_BATCH_SIZE))
+
+        # Point in time quantities
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_products_available_as_of(
+                ids integer[],
+                as_of timestamp
+            )
+            RETURNS TABLE (
+                product_id integer,
+                qty_available numeric,
+                virtual_available numeric,
+                incoming_qty numeric,
+                outgoing_qty numeric
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                results = iplpy.get_products_available(ids, as_of=as_of)
+                return [
+                    dict(vals, product_id=product_id)
+                    for product_id, vals in results.items()
+                ]
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_checkpoint(
+                checkpoint_time timestamp default null,
+                ids integer[] default null
+            )
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.create_checkpoints(checkpoint_time, ids)
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Instrumentation of this backend
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_stats()
+            RETURNS TABLE (
+                name text,
+                calls bigint,
+                total_ms float8,
+                max_ms float8,
+                avg_ms float8,
+                queries bigint,
+                rows bigint
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.stats()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_stats_reset()
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                iplpy.reset_stats()
+                return "OK"
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Lets many sessions share the sync work. Each call of the
+        # function does one batch in the caller's transaction while the
+        # procedure commits after every batch until everything is synced
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_sync_product_product_summary_worker(batch_size integer default 100)
+            RETURNS INTEGER AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.sync_product_product_summary_worker(batch_size)
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE OR REPLACE PROCEDURE sp_sync_product_product_summary_worker(
+                batch_size integer default 100,
+                max_batches integer default null
+            )
+            AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                iplpy.run_sync_product_product_summary_worker(batch_size, max_batches)
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        # Ensure we can vacuum the database of too many entries. The old
+        # argumentless version would make calls without arguments
+        # ambiguous so it has to go
+        self.q("""
+            DROP FUNCTION IF EXISTS fn_zerp_plpy_vacuum()
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_vacuum(
+                batch_size integer default {batch_size},
+                max_seconds float8 default {max_seconds},
+                max_rows integer default null
+            )
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.vacuum(batch_size, max_seconds, max_rows)
+            $$
+            LANGUAGE plpython3u
+        """.format(
+            batch_size=VACUUM_BATCH_SIZE,
+            max_seconds=VACUUM_MAX_SECONDS,
+        ))
+
+        # Cheap check of the stored quantities against stock_move
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_audit(
+                max_seconds float8 default {max_seconds},
+                range_size integer default {range_size}
+            )
+            RETURNS TABLE (
+                first_id integer,
+                last_id integer,
+                ranges integer,
+                drifted_ranges integer,
+                drifted_products integer[],
+                seconds float8
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return [ iplpy.audit_drift(max_seconds, range_size) ]
+            $$
+            LANGUAGE plpython3u
+        """.format(
+            max_seconds=AUDIT_MAX_SECONDS,
+            range_size=AUDIT_RANGE_SIZE,
+        ))
+
+        # Allow checking how well the prepared plan cache is doing
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_zerp_plpy_plan_cache_stats()
+            RETURNS TABLE ( hits bigint, misses bigint, plans integer ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return [ iplpy.plan_cache_stats() ]
+            $$
+            LANGUAGE plpython3u
+        """)
+
+
+        # UoM changes need to invalidate the cached UoM data as well as
+        # the quantities of the products involved
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_trigger_uom_changes()
+            RETURNS TRIGGER AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.trigger_uom_changes()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            DROP TRIGGER IF EXISTS trig_uom_changes_updel ON product_uom
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_uom_changes_updel
+            BEFORE UPDATE OF    category_id,
+                                factor,
+                                rounding
+            ON
+                                product_uom
+            FOR EACH ROW
+            EXECUTE PROCEDURE   fn_trigger_uom_changes()
+        """)
+
+        # Lets trigger_location_changes find the products moved in or
+        # out of a location without scanning stock_move
+        self.q("""
+            CREATE INDEX IF NOT EXISTS ndx_zerp_stock_move_location_product
+            ON           stock_move ( location_id, product_id )
+        """)
+        self.q("""
+            CREATE INDEX IF NOT EXISTS ndx_zerp_stock_move_location_dest_product
+            ON           stock_move ( location_dest_id, product_id )
+        """)
+
+        # Covers the stock_move columns get_products_available needs so
+        # the per batch recalculation can be done with index only scans
+        self.q("""
+            CREATE INDEX IF NOT EXISTS ndx_zerp_stock_move_qty
+            ON           stock_move ( product_id, state )
+            INCLUDE      ( product_uom, product_qty, location_id, location_dest_id, date )
+            WHERE        state IN ( {states} )
+        """.format(
+            states=", ".join( "'{}'".format(state) for state in STOCK_MOVE_QTY_STATES )
+        ))
+
+        # Moving or removing a location changes which moves count as
+        # internal for every location in its subtree
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_trigger_location_changes()
+            RETURNS TRIGGER AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.trigger_location_changes()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            DROP TRIGGER IF EXISTS trig_location_changes_updel ON stock_location
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_location_changes_updel
+            BEFORE UPDATE OF    active,
+                                location_id
+                OR DELETE
+            ON
+                                stock_location
+            FOR EACH ROW
+            EXECUTE PROCEDURE   fn_trigger_location_changes()
+        """)
+
+        self.install_stock_move_triggers(stock_move_trigger_mode)
+        self.install_location_matrix(location_matrix)
+
+        return "Installed!"
+
+    def install_history(self, keep_history=True):
+        """ Turns on or off the recording of every change made to
+            zerp_product_summary into zerp_product_dirty_log. Turning it
+            off leaves the existing log in place
+        """
+        self.q("""
+            DROP TRIGGER IF EXISTS trig_zerp_product_summary_history
+            ON zerp_product_summary
+        """)
+
+        self.set_setting('keep_history', keep_history and 1 or 0)
+        if not keep_history:
+            return False
+
+        self.q("""
+            CREATE TABLE IF NOT EXISTS zerp_product_dirty_log (
+                  id serial primary key,
+                  product_id integer not null,
+                  update_time timestamp not null,
+                  dirty boolean not null,
+                  cached_qty_available numeric,
+                  cached_virtual_available numeric,
+                  cached_incoming_qty numeric,
+                  cached_outgoing_qty numeric
+            )
+        """)
+        self.q("""
+            CREATE INDEX IF NOT EXISTS ndx_zerp_product_dirty_log_update
+            ON           zerp_product_dirty_log
+                        ( product_id, update_time desc, dirty desc );
+        """)
+
+        # Lets vacuum find newer entries for the same product quickly
+        self.q("""
+            CREATE INDEX IF NOT EXISTS ndx_zerp_product_dirty_log_product_id
+            ON           zerp_product_dirty_log
+                        ( product_id, id );
+        """)
+
+        # A plain copy of the row doesn't need python
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_trigger_zerp_product_summary_history()
+            RETURNS TRIGGER AS
+            $$
+            BEGIN
+                INSERT INTO zerp_product_dirty_log
+                        (
+                            product_id, update_time, dirty,
+                            cached_qty_available,
+                            cached_virtual_available,
+                            cached_incoming_qty,
+                            cached_outgoing_qty
+                        )
+                VALUES  (
+                            NEW.product_id, NEW.update_time, NEW.dirty,
+                            NEW.cached_qty_available,
+                            NEW.cached_virtual_available,
+                            NEW.cached_incoming_qty,
+                            NEW.cached_outgoing_qty
+                        );
+                RETURN NULL;
+            END
+            $$
+            LANGUAGE plpgsql;
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_zerp_product_summary_history
+            AFTER INSERT OR UPDATE
+            ON
+                                zerp_product_summary
+            FOR EACH ROW
+            EXECUTE PROCEDURE   fn_trigger_zerp_product_summary_history()
+        """)
+
+        return True
+
+    def install_dirty_coalescing(self, coalesce_dirty=True):
+        """ Turns on or off the collecting of dirty products for the
+            length of the transaction. When on, mark_products_dirty only
+            remembers the ids and queues a row in zerp_product_dirty_queue.
+            The deferred constraint trigger on that table then flags them
+            all with a single write when the transaction commits
+        """
+        # Rows only ever live for the length of a transaction so there's
+        # no point in them going through the WAL
+        self.q("""
+            CREATE UNLOGGED TABLE IF NOT EXISTS zerp_product_dirty_queue (
+                  txid bigint not null
+            )
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_trigger_flush_dirty_products()
+            RETURNS TRIGGER AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.trigger_flush_dirty_products()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            DROP TRIGGER IF EXISTS trig_zerp_product_dirty_flush
+            ON zerp_product_dirty_queue
+        """)
+        self.q("""
+            CREATE CONSTRAINT TRIGGER trig_zerp_product_dirty_flush
+            AFTER INSERT
+            ON
+                                zerp_product_dirty_queue
+            DEFERRABLE INITIALLY DEFERRED
+            FOR EACH ROW
+            EXECUTE PROCEDURE   fn_trigger_flush_dirty_products()
+        """)
+
+        self.set_setting('coalesce_dirty', coalesce_dirty and 1 or 0)
+        return bool(coalesce_dirty)
+
+    def install_location_matrix(self, location_matrix=True):
+        """ Turns on or off the maintaining of zerp_product_location_qty,
+            the signed quantity of each product moved into each location
+            by state and by the UoM of the moves. Statement triggers on
+            stock_move apply the changes to it as deltas so it's always
+            current. Turning it off leaves the table in place and it's
+            rebuilt (see rebuild_location_matrix) when turned on again
+        """
+        # Whatever happened to stock_move while the triggers weren't
+        # there is missing from the table
+        was_maintained = self.get_setting('location_matrix')
+
+        for trigger_name in LOCATION_MATRIX_TRIGGERS:
+            self.q("""
+                DROP TRIGGER IF EXISTS {trigger_name} ON stock_move
+            """.format(trigger_name=trigger_name))
+
+        if not location_matrix:
+            self.set_setting('location_matrix', 0)
+            return False
+
+        if not self.table_exists('zerp_product_location_qty'):
+            self.q("""
+                CREATE TABLE zerp_product_location_qty (
+                      product_id integer not null,
+                      location_id integer not null,
+                      product_uom integer not null,
+                      state varchar not null,
+                      qty numeric not null,
+                      primary key ( product_id, location_id, product_uom, state )
+                )
+            """)
+
+            # For the range queries which go location first
+            self.q("""
+                CREATE INDEX ndx_zerp_product_location_qty_location
+                ON           zerp_product_location_qty ( location_id, product_id )
+            """)
+            was_maintained = False
+
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_trigger_stock_move_location_matrix()
+            RETURNS TRIGGER AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.trigger_stock_move_location_matrix()
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_stock_move_location_matrix_insert
+            AFTER INSERT
+            ON
+                                stock_move
+            REFERENCING         NEW TABLE AS zerp_stock_move_new
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE   fn_trigger_stock_move_location_matrix()
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_stock_move_location_matrix_update
+            AFTER UPDATE
+            ON
+                                stock_move
+            REFERENCING         OLD TABLE AS zerp_stock_move_old
+                                NEW TABLE AS zerp_stock_move_new
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE   fn_trigger_stock_move_location_matrix()
+        """)
+        self.q("""
+            CREATE TRIGGER      trig_stock_move_location_matrix_delete
+            AFTER DELETE
+            ON
+                                stock_move
+            REFERENCING         OLD TABLE AS zerp_stock_move_old
+            FOR EACH STATEMENT
+            EXECUTE PROCEDURE   fn_trigger_stock_move_location_matrix()
+        """)
+
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_get_location_quantities(
+                location_id integer,
+                ids integer[] default null
+            )
+            RETURNS TABLE (
+                product_id integer,
+                qty_available numeric,
+                virtual_available numeric
+            ) AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                results = iplpy.get_location_quantities([location_id], ids)
+                return [
+                    dict(vals, product_id=product_id)
+                    for product_id, vals in results[location_id].items()
+                ]
+            $$
+            LANGUAGE plpython3u;
+        """)
+        self.q("""
+            CREATE OR REPLACE FUNCTION fn_rebuild_location_matrix(ids integer[] default null)
+            RETURNS TEXT AS
+            $$
+                from izaber.plpython.zerp import init_plpy
+                iplpy = init_plpy(globals())
+                return iplpy.rebuild_location_matrix(ids)
+            $$
+            LANGUAGE plpython3u;
+        """)
+
+        if not was_maintained:
+            self.rebuild_location_matrix()
+
+        self.set_setting('location_matrix', 1)
+        return True
+
+    def install_stock_move_triggers(self, mode='row'):
+        """ (Re)creates the triggers on stock_move that flag products as
+            dirty. Any triggers from the other mode are removed so that
+            we can switch back and forth by calling install again
+        """
+        if mode not in STOCK_MOVE_TRIGGER_MODES:
+            raise Exception("Unknown stock_move trigger mode '{}'".format(mode))
+
+        # Kept so that a later install without a mode leaves it as is
+        self.set_setting('stock_move_trigger_mode', STOCK_MOVE_TRIGGER_MODES.index(mode))
+
+        for trigger_name in STOCK_MOVE_TRIGGERS:
+            self.q("""
+                DROP TRIGGER IF EXISTS {trigger_name} ON stock_move
+            """.format(trigger_name=trigger_name))
+
+        if mode == 'row':
             self.q("""
-                CREATE OR REPLACE FUNCTION fn_sync_product_product_summary()
-                RETURNS TEXT AS
+                CREATE OR REPLACE FUNCTION fn_trigger_stock_move_changes()
+                RETURNS TRIGGER AS
                 $$
                     from izaber.plpython.zerp import init_plpy
                     iplpy = init_plpy(globals())
-                    return iplpy.sync_product_product_summary()
+                    return iplpy.trigger_stock_move_changes()
                 $$
                 LANGUAGE plpython3u;
             """)
             self.q("""
-                CREATE OR REPLACE FUNCTION fn_sync_product_product_summary(ids integer[])
-                RETURNS TEXT AS
+                CREATE TRIGGER      trig_stock_move_qty_changes_update
+                BEFORE UPDATE OF    product_uom,
+                                    product_qty,
+                                    location_id,
+                                    location_dest_id,
+                                    product_id,
+                                    state,
+                                    date
+                ON
+                                    stock_move
+                FOR EACH ROW
+                EXECUTE PROCEDURE   fn_trigger_stock_move_changes()
+            """)
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_changes_insdel
+                BEFORE INSERT OR DELETE
+                ON
+                                    stock_move
+                FOR EACH ROW
+                EXECUTE PROCEDURE   fn_trigger_stock_move_changes()
+            """)
+
+        elif mode == 'statement':
+            self.q("""
+                CREATE OR REPLACE FUNCTION fn_trigger_stock_move_changes_statement()
+                RETURNS TRIGGER AS
                 $$
                     from izaber.plpython.zerp import init_plpy
                     iplpy = init_plpy(globals())
-                    return iplpy.sync_product_product_summary(ids)
+                    return iplpy.trigger_stock_move_changes_statement()
                 $$
                 LANGUAGE plpython3u;
             """)
 
+            # Transition tables can't be combined with a column list on
+            # UPDATE triggers, so the column filtering happens in the
+            # trigger's query instead
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_changes_stmt_insert
+                AFTER INSERT
+                ON
+                                    stock_move
+                REFERENCING         NEW TABLE AS zerp_stock_move_new
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE   fn_trigger_stock_move_changes_statement()
+            """)
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_changes_stmt_update
+                AFTER UPDATE
+                ON
+                                    stock_move
+                REFERENCING         OLD TABLE AS zerp_stock_move_old
+                                    NEW TABLE AS zerp_stock_move_new
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE   fn_trigger_stock_move_changes_statement()
+            """)
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_changes_stmt_delete
+                AFTER DELETE
+                ON
+                                    stock_move
+                REFERENCING         OLD TABLE AS zerp_stock_move_old
+                FOR EACH STATEMENT
+                EXECUTE PROCEDURE   fn_trigger_stock_move_changes_statement()
+            """)
 
-            # Ensure we can vacuum the database of too many entries
+        elif mode == 'incremental':
             self.q("""
-                CREATE OR REPLACE FUNCTION fn_zerp_plpy_vacuum()
-                RETURNS TEXT AS
+                CREATE OR REPLACE FUNCTION fn_trigger_stock_move_delta()
+                RETURNS TRIGGER AS
                 $$
                     from izaber.plpython.zerp import init_plpy
                     iplpy = init_plpy(globals())
-                    return iplpy.vacuum()
+                    return iplpy.trigger_stock_move_delta()
                 $$
-                LANGUAGE plpython3u
+                LANGUAGE plpython3u;
             """)
 
+            # These run AFTER so that we only ever account for rows that
+            # have actually been written
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_delta_update
+                AFTER UPDATE OF     product_uom,
+                                    product_qty,
+                                    location_id,
+                                    location_dest_id,
+                                    product_id,
+                                    state,
+                                    date
+                ON
+                                    stock_move
+                FOR EACH ROW
+                EXECUTE PROCEDURE   fn_trigger_stock_move_delta()
+            """)
+            self.q("""
+                CREATE TRIGGER      trig_stock_move_qty_delta_insdel
+                AFTER INSERT OR DELETE
+                ON
+                                    stock_move
+                FOR EACH ROW
+                EXECUTE PROCEDURE   fn_trigger_stock_move_delta()
+            """)
 
+        return mode
+
+    @instrumented
+    def vacuum(self,
+                batch_size=VACUUM_BATCH_SIZE,
+                max_seconds=VACUUM_MAX_SECONDS,
+                max_rows=None):
+        """ Cleans up the history log by removing all but the newest entry
+            of each product.
+
+            The log is worked through in id ranges of batch_size rows,
+            stopping once max_seconds have passed or max_rows have been
+            removed. Where it stopped is remembered in zerp_plpy_state so
+            the next call carries on from there, starting over from the
+            beginning once the end of the log is reached.
+
+            With a batch_size of 0 the whole log is cleaned in a single
+            statement. This may be slow so be careful when this is called.
+            Also call this when things are quiet since this might cause
+            concurrency issues during busy times.
+        """
+        if not self.table_exists('zerp_product_dirty_log'):
+            return "No history log"
 
-        return "Installed!"
+        start_time = time.monotonic()
+
+        # Delete all but the most recent entries from the log
+        if not batch_size:
+            result = self.qp('vacuum', """
+                DELETE FROM zerp_product_dirty_log
+                WHERE
+                        id not in (
+                            select distinct on (product_id) id
+                            from
+                                zerp_product_dirty_log
+                            order by product_id, update_time desc, dirty desc, id desc
+                        )
+            """)
+            elapsed = time.monotonic() - start_time
+            return "Removed {} row(s) in {:.1f}s ({:.0f} rows/s)".format(
+                        result.nrows(),
+                        elapsed,
+                        result.nrows() / elapsed if elapsed else 0
+                    )
+
+        max_id = self.qp('vacuum_max_id', """
+            SELECT  COALESCE(MAX(id),0) max_id
+            FROM    zerp_product_dirty_log
+        """)[0]['max_id']
+
+        last_id = self.get_state('vacuum:last_id')
+        if last_id >= max_id:
+            last_id = 0
+
+        removed = 0
+        while last_id < max_id:
+            batch_end = min(last_id + batch_size, max_id)
+            result = self.qp('vacuum_batch', """
+                DELETE FROM zerp_product_dirty_log l
+                WHERE
+                        l.id > $1
+                    AND l.id <= $2
+                    AND EXISTS (
+                            SELECT  1
+                            FROM    zerp_product_dirty_log n
+                            WHERE   n.product_id = l.product_id
+                                AND n.id > l.id
+                        )
+            """,["bigint","bigint"],[last_id, batch_end])
+            removed += result.nrows()
+            last_id = batch_end
+
+            if max_seconds and time.monotonic() - start_time >= max_seconds:
+                break
+            if max_rows and removed >= max_rows:
+                break
 
-    def vacuum(self):
-        """ Cleans up the database. This may be slow so be careful when
-            this is called. Also call this when things are quiet since
-            this might cause concurrency issues during busy times.
+        # Remember where we got to for the next call
+        self.set_state('vacuum:last_id', last_id)
+
+        elapsed = time.monotonic() - start_time
+        return "Removed {} row(s) in {:.1f}s ({:.0f} rows/s), {} at id {} of {}".format(
+                    removed,
+                    elapsed,
+                    removed / elapsed if elapsed else 0,
+                    'finished' if last_id >= max_id else 'stopped',
+                    last_id,
+                    max_id
+                )
+
+    @instrumented
+    def audit_drift(self,
+                max_seconds=AUDIT_MAX_SECONDS,
+                range_size=AUDIT_RANGE_SIZE):
+        """ Checks that the clean quantities in zerp_product_summary still
+            match what get_products_available would work out, flagging
+            any that don't as dirty.
+
+            Rather than recalculating each product, checksums of both the
+            stored and the recalculated quantities are taken over ranges
+            of range_size product ids, all in SQL. Only the ranges where
+            they differ are bisected down to the products responsible.
+
+            The product ids are worked through until max_seconds have
+            passed. Where it stopped is remembered in zerp_plpy_state so
+            the next call carries on from there, starting over from the
+            beginning once the end is reached. Returns a hash of what was
+            covered and found
         """
+        start_time = time.monotonic()
+
+        max_id = self.qp('audit_drift_max_id', """
+            SELECT  COALESCE(MAX(id),0) max_id
+            FROM    product_product
+        """)[0]['max_id']
+
+        first_id = self.get_state('audit:last_id')
+        if first_id > max_id:
+            first_id = 0
+
+        position = first_id
+        ranges = 0
+        drifted_ranges = 0
+        drifted_product_ids = []
+        while position <= max_id:
+            chunk_end = min(position + range_size * AUDIT_CHUNK_RANGES, max_id + 1)
+            differing = self.audit_differing_ranges(position, chunk_end, range_size)
+            ranges += ( chunk_end - position + range_size - 1 ) // range_size
+            drifted_ranges += len(differing)
+
+            # Narrow things down to the products responsible
+            while differing:
+                range_start, range_end = differing.pop()
+                if range_end - range_start <= AUDIT_LEAF_SIZE:
+                    drifted_product_ids += self.audit_products(range_start, range_end)
+                    continue
+                half = ( range_end - range_start + 1 ) // 2
+                differing += self.audit_differing_ranges(range_start, range_end, half)
+
+            position = chunk_end
+            if max_seconds and time.monotonic() - start_time >= max_seconds:
+                break
 
-        # Delete all but the most recent entries from the log
-        self.q("""
-            DELETE FROM zerp_product_dirty_log
+        # Remember where we got to for the next call
+        self.set_state('audit:last_id', position)
+
+        self.mark_products_dirty(drifted_product_ids)
+
+        return {
+            'first_id': first_id,
+            'last_id': position,
+            'ranges': ranges,
+            'drifted_ranges': drifted_ranges,
+            'drifted_products': sorted(drifted_product_ids),
+            'seconds': time.monotonic() - start_time,
+        }
+
+    @instrumented
+    def audit_differing_ranges(self, first_id, last_id, range_size):
+        """ Splits the product ids from first_id up to (but not including)
+            last_id into ranges of range_size ids and returns a list of
+            the ( start, end ) of those where the checksums of the clean
+            stored quantities and the recalculated ones don't match
+        """
+        internal_location_ids = list(self.get_stock_locations())
+
+        cached = self.qp('audit_checksums_cached', """
+            SELECT
+                    $1 + ( product_id - $1 ) / $3 * $3 range_start,
+                    SUM(cached_qty_available) qty_available,
+                    SUM(cached_virtual_available) virtual_available,
+                    SUM(cached_qty_available * ( product_id % {modulus} + 1 )) weighted_qty_available,
+                    SUM(cached_virtual_available * ( product_id % {modulus} + 1 )) weighted_virtual_available
+            FROM
+                    zerp_product_summary
             WHERE
-                    id not in (
-                        select distinct on (product_id) id
-                        from
-                            zerp_product_dirty_log
-                        order by product_id, update_time desc, dirty desc
-                    )
-        """)
+                    NOT dirty
+                AND product_id >= $1
+                AND product_id < $2
+            GROUP BY
+                    1
+        """.format(
+            modulus=AUDIT_CHECKSUM_MODULUS
+        ),["int","int","int"],[first_id, last_id, range_size])
 
-    def get_uom_data(self, uom_id):
-        """ Fetches basic information from DB about product.uom
-            Caches as needed
-            TODO: Cache expiry when DB changes
+        # The same aggregate as get_products_available only totalled by
+        # range rather than by product. Products that have never been
+        # calculated are included so that they show up as drift
+        recalculated = self.qp('audit_checksums_recalculated', """
+            SELECT
+                    $1 + ( q.product_id - $1 ) / $3 * $3 range_start,
+                    SUM(CASE WHEN q.state = 'done' THEN q.product_qty ELSE 0 END) qty_available,
+                    SUM(q.product_qty) virtual_available,
+                    SUM(CASE WHEN q.state = 'done' THEN q.product_qty ELSE 0 END
+                            * ( q.product_id % {modulus} + 1 )) weighted_qty_available,
+                    SUM(q.product_qty * ( q.product_id % {modulus} + 1 )) weighted_virtual_available
+            FROM (
+                SELECT
+                                    c.product_id,
+                                    c.state,
+                                    CASE
+                                        WHEN c.direction = 'in'
+                                            THEN 1
+                                        ELSE -1
+                                    END * {converted_qty} product_qty
+                FROM (
+                                    select
+                                            SUM(m.product_qty) product_qty,
+                                            CASE
+                                                WHEN src.location_id IS NULL
+                                                    THEN 'in'
+                                                ELSE 'out'
+                                            END direction,
+                                            m.product_id,
+                                            m.product_uom,
+                                            m.state
+                                    from
+                                            stock_move m
+                                    left join
+                                            unnest($4::int[]) src (location_id)
+                                        on  src.location_id = m.location_id
+                                    left join
+                                            unnest($4::int[]) dst (location_id)
+                                        on  dst.location_id = m.location_dest_id
+                                    left join
+                                            zerp_product_summary s
+                                        on  s.product_id = m.product_id
+                                    where
+                                            ( src.location_id IS NULL ) <> ( dst.location_id IS NULL )
+                                        and m.product_id >= $1
+                                        and m.product_id < $2
+                                        and m.state IN ('confirmed','waiting','assigned','done')
+                                        and s.dirty IS NOT TRUE
+                                    group by
+                                        m.product_id,
+                                        m.product_uom,
+                                        direction,
+                                        m.state
+                                ) as c
+                    LEFT JOIN
+                                product_product pp
+                            ON  pp.id = c.product_id
+                    LEFT JOIN
+                                product_template pt
+                            ON  pt.id = pp.product_tmpl_id
+                    LEFT JOIN
+                                product_uom fu
+                            ON  fu.id = c.product_uom
+                    LEFT JOIN
+                                product_uom tu
+                            ON  tu.id = pt.uom_id
+            ) q
+            GROUP BY
+                    1
+        """.format(
+            modulus=AUDIT_CHECKSUM_MODULUS,
+            converted_qty=UOM_CONVERT_EXPRESSIONS['sql']
+        ),["int","int","int","int[]"],[first_id, last_id, range_size, internal_location_ids])
+
+        checksum_keys = (
+            'qty_available',
+            'virtual_available',
+            'weighted_qty_available',
+            'weighted_virtual_available',
+        )
+        checksums = {}
+        for side, data in enumerate(( cached, recalculated )):
+            for row in data:
+                sums = checksums.setdefault(row['range_start'], [ (0,0,0,0), (0,0,0,0) ])
+                sums[side] = tuple( row[key] or 0 for key in checksum_keys )
+
+        differing = []
+        for range_start, sums in sorted(checksums.items()):
+            if sums[0] != sums[1]:
+                differing.append(( range_start, min(range_start + range_size, last_id) ))
+        return differing
+
+    @instrumented
+    def audit_products(self, first_id, last_id):
+        """ Compares the stored quantities of the products with ids from
+            first_id up to (but not including) last_id with freshly
+            calculated ones. Returns the ids of the ones that differ.
+            Products already flagged as dirty are skipped
+        """
+        data = self.qp('audit_products', """
+            SELECT  id
+            FROM    product_product
+            WHERE
+                    id >= $1
+                AND id < $2
+        """,["int","int"],[first_id, last_id])
+        product_ids = [ row['id'] for row in data ]
+        if not product_ids:
+            return []
+
+        cached = self.get_cached_products_available(product_ids)
+        calculated = self.get_products_available(product_ids)
+
+        drifted_product_ids = []
+        for product_id in product_ids:
+            entry = cached.get(product_id)
+            if entry and entry['dirty']:
+                continue
+            values = calculated[product_id]
+            if entry is None:
+                if any(values.values()):
+                    drifted_product_ids.append(product_id)
+                continue
+            for key, value in values.items():
+                if entry[key] != value:
+                    drifted_product_ids.append(product_id)
+                    break
+        return drifted_product_ids
+
+    @instrumented
+    def get_uom_table(self, reload=False):
+        """ Returns a hash of every product.uom id to a tuple of
+            ( category_id, factor, rounding ). The whole table is loaded
+            in one go and kept in GD until the 'uom' cache generation
+            changes (see trigger_uom_changes)
         """
-        if uom_id not in self.GD.setdefault('uom_data_cache',{}):
-            data = self.q("""
+        generation = self.cache_generation('uom')
+        cached = self.GD.get('uom_table')
+        if reload or not cached or cached[0] != generation:
+            self.count_event('uom_table.miss')
+            data = self.qp('get_uom_table', """
             SELECT
                     id,
                     category_id,
@@ -142,14 +1690,29 @@ class IPLPY(izaber.plpython.base.IPLPY):
                     rounding
             FROM
                     product_uom
-            WHERE
-                    id = $1
-            """,["int"],[uom_id])
-
-            self.GD['uom_data_cache'][uom_id] = data and data[0] or None
-
-        return self.GD['uom_data_cache'][uom_id]
+            """)
+            uoms = {}
+            for row in data:
+                uoms[row['id']] = ( row['category_id'], row['factor'], row['rounding'] )
+            cached = ( generation, uoms )
+            self.GD['uom_table'] = cached
+        else:
+            self.count_event('uom_table.hit')
+        return cached[1]
 
+    def get_uom_data(self, uom_id):
+        """ Returns ( category_id, factor, rounding ) for the product.uom
+            or None if it doesn't exist
+        """
+        uoms = self.get_uom_table()
+        if uom_id not in uoms and not self.generations_seen.get('uom_reloaded'):
+            # Newly created UoMs don't bump the generation so give the
+            # table one more chance before giving up on the id
+            self.generations_seen['uom_reloaded'] = True
+            uoms = self.get_uom_table(reload=True)
+        return uoms.get(uom_id)
+
+    @instrumented
     def uom_convert(self, from_uom_id, qty, to_uom_id ):
         """ Replication of the Zerp's UoM conversion function that
             takes one UoM amount to a another UoM based upon the
@@ -162,107 +1725,276 @@ class IPLPY(izaber.plpython.base.IPLPY):
            or from_uom_id == to_uom_id:
                 return qty
 
-        # FIXME: this is the best way?
-        from_unit = self.get_uom_data(from_uom_id)
-        to_unit = self.get_uom_data(to_uom_id)
+        # FIXME: this is the best way?
+        from_unit = self.get_uom_data(from_uom_id)
+        to_unit = self.get_uom_data(to_uom_id)
+
+        if not ( from_unit and to_unit ):
+            raise Exception("Unknown UoM IDs specified")
+
+        from_category_id, from_factor, from_rounding = from_unit
+        to_category_id, to_factor, to_rounding = to_unit
+
+        # Guard clause, we don't want to try and convert from a length
+        # to a weight, for instance
+        if from_category_id != to_category_id:
+            raise Exception('Conversion from Product UoM to Default UoM is not possible as they both belong to different Category!.')
+
+        # Calculate the ratios and such
+        amount = qty / from_factor
+        amount = self.rounding(amount * to_factor, to_rounding)
+
+        return amount
+
+    @instrumented
+    def get_internal_locations(self):
+        """ Returns the StockLocations we consider "within Zaber" for the
+            purposes of calulating values such as QoH. That's every
+            location under the stock location of any of the warehouses.
+
+            The result is kept in GD until the 'stock_locations' cache
+            generation changes (see trigger_location_changes)
+        """
+        generation = self.cache_generation('stock_locations')
+        locations = self.GD.get('stock_internal_locations')
+        if locations is None or locations.generation != generation:
+            self.count_event('stock_locations.miss')
+
+            # find the locations under each warehouse's stock location. Where warehouses are nested
+            # the innermost one wins as the smaller subtrees come last
+            sl_recs = self.qp('get_stock_locations_children', """
+                          SELECT        sl.id,
+                                        sw.id "warehouse_id"
+                          FROM          stock_warehouse sw
+                          JOIN          stock_location root
+                          ON            sw.lot_stock_id = root.id
+                          JOIN          stock_location sl
+                          ON            sl.parent_left >= root.parent_left
+                                    AND sl.parent_left < root.parent_right
+                          ORDER BY      root.parent_right - root.parent_left DESC,
+                                        sw.id
+                        """)
+
+            locations = StockLocations(
+                            generation,
+                            [
+                                ( sl_rec['id'], sl_rec['warehouse_id'] )
+                                for sl_rec in sl_recs
+                            ]
+                        )
+            self.GD['stock_internal_locations'] = locations
+        else:
+            self.count_event('stock_locations.hit')
+
+        return locations
+
+    def get_stock_locations(self):
+        """ Returns a list of stock.location ids reflecting locations we consider
+            "within Zaber" for the purposes of calulating values such as QoH
+        """
+        return self.get_internal_locations().ids
+
+    @instrumented
+    def get_products_available(self, product_ids, uom_convert_mode='sql', by_warehouse=False, as_of=None):
+        """ Returns a hash of product quantities available
+            We sum all the in/out moves as two different queries.
+
+            By default the UoM conversion is done by the database with a
+            join against product_uom. Setting uom_convert_mode to 'python'
+            converts each summed row through fn_uom_convert/uom_convert
+            instead, which is much slower but handy for checking that both
+            produce the same results
+
+            With by_warehouse each product's hash also gets a 'warehouses'
+            key holding the same quantities per warehouse id (see
+            get_products_available_by_warehouse)
+
+            With as_of only the moves dated up to then are counted (see
+            get_products_available_as_of)
+        """
+        if uom_convert_mode not in UOM_CONVERT_MODES:
+            raise Exception("Unknown UoM conversion mode '{}'".format(uom_convert_mode))
+
+        if as_of is not None:
+            if by_warehouse:
+                raise Exception("Per warehouse quantities aren't available with as_of")
+            return self.get_products_available_as_of(product_ids, as_of, uom_convert_mode)
+
+        internal_location_ids = list(self.get_stock_locations())
+        product_id_list = list(map(int,product_ids))
+
+        counts = self.qp(
+            'get_products_available_'+uom_convert_mode,
+            """
+            SELECT
+                                c.product_id,
+                                direction,
+                                SUM({converted_qty}) product_qty,
+                                c.state
+            FROM (
+                                -- This query takes the various states and sums up the values
+                                -- of all the stock move lines. Whether each end of the move
+                                -- is internal comes from joining against the internal
+                                -- locations so the moves can be read straight out of
+                                -- ndx_zerp_stock_move_qty
+                                select
+                                        SUM(m.product_qty) product_qty,
+                                        CASE
+                                            WHEN src.location_id IS NULL
+                                                THEN 'in'
+                                            ELSE 'out'
+                                        END direction,
+                                        m.product_id,
+                                        m.product_uom,
+                                        m.state
+                                from
+                                        stock_move m
+                                left join
+                                        unnest($2::int[]) src (location_id)
+                                    on  src.location_id = m.location_id
+                                left join
+                                        unnest($2::int[]) dst (location_id)
+                                    on  dst.location_id = m.location_dest_id
+                                where
+                                        -- only moves crossing in or out of the internal
+                                        -- locations
+                                        ( src.location_id IS NULL ) <> ( dst.location_id IS NULL )
+                                    and m.product_id = ANY($1::int[])
+                                    and m.state IN ('confirmed','waiting','assigned','done')
+                                group by
+                                    m.product_id,
+                                    m.product_uom,
+                                    direction,
+                                    m.state
+                            ) as c
+                LEFT JOIN
+                            product_product pp
+                        ON  pp.id = c.product_id
+                LEFT JOIN
+                            product_template pt
+                        ON  pt.id = pp.product_tmpl_id
+                LEFT JOIN
+                            product_uom fu
+                        ON  fu.id = c.product_uom
+                LEFT JOIN
+                            product_uom tu
+                        ON  tu.id = pt.uom_id
+            GROUP BY
+                c.product_id, c.direction, c.state
+            """.format(
+                converted_qty=UOM_CONVERT_EXPRESSIONS[uom_convert_mode]
+            ),
+            ["int[]","int[]"],
+            [product_id_list, internal_location_ids]
+        )
+
 
-        if not ( from_unit and to_unit ):
-            raise Exception("Unknown UoM IDs specified")
+        by_product_id = {}
+        for product_id in product_id_list:
+            by_product_id[product_id] = self.empty_quantities()
 
-        # Guard clause, we don't want to try and convert from a length
-        # to a weight, for instance
-        if from_unit['category_id'] != to_unit['category_id']:
-            raise Exception('Conversion from Product UoM to Default UoM is not possible as they both belong to different Category!.')
+        for count in counts:
+            product_id = count['product_id']
+            self.add_quantity(
+                by_product_id[product_id],
+                count['direction'],
+                count['state'],
+                count['product_qty']
+            )
+
+        if by_warehouse:
+            by_warehouse_id = self.get_products_available_by_warehouse(
+                                    product_id_list,
+                                    uom_convert_mode
+                                )
+            for product_id, warehouses in by_warehouse_id.items():
+                by_product_id[product_id]['warehouses'] = warehouses
 
-        # Calculate the ratios and such
-        amount = qty / from_unit['factor']
-        amount = self.rounding(amount * to_unit['factor'], to_unit['rounding'])
+        return by_product_id
 
-        return amount
+    @instrumented
+    def get_products_available_as_of(self, product_ids, as_of, uom_convert_mode='sql'):
+        """ Returns the same hash as get_products_available but only
+            counting the stock moves dated on or before as_of.
 
-    def get_stock_locations(self):
-        """ Returns a list of stock.location ids reflecting locations we consider
-            "within Zaber" for the purposes of calulating values such as QoH
+            Rather than going through every move, we start from each
+            product's most recent checkpoint at or before as_of (see
+            create_checkpoints) and only add the moves dated after it
         """
+        if uom_convert_mode not in UOM_CONVERT_MODES:
+            raise Exception("Unknown UoM conversion mode '{}'".format(uom_convert_mode))
 
-        if 'stock_internal_locations' not in self.GD:
-            # FIXME: This should be cached
-            # Find all the warehouse locations
-            sl_rec = self.q("""
-                            SELECT      sw.id "warehouse_id",
-                                        sl.id "location_id",
-                                        sl.parent_left,
-                                        sl.parent_right
-                            FROM        stock_warehouse sw
-                            LEFT JOIN   stock_location sl
-                            ON          sw.lot_stock_id = sl.id
-                        """,[],[])[0]
-
-            # find the locations associated
-            sl_recs = self.q("""
-                          SELECT        id
-                          FROM          stock_location
-                          WHERE
-                                        parent_left < $1
-                                    AND parent_right >= $2
-                        """,
-                        ["integer","integer"],
-                        [sl_rec['parent_right'], sl_rec['parent_left']])
-            sl_ids = []
-            for sl_rec in sl_recs:
-                sl_ids.append(sl_rec['id'])
-            self.GD['stock_internal_locations'] = sl_ids
-
-        return self.GD['stock_internal_locations']
-
-    def get_products_available(self, product_ids):
-        """ Returns a hash of product quantities available
-            We sum all the in/out moves as two different queries. Note that
-            we have to handle UoM after the fact as the database doesn't
-            necessarily know how to multiply/etc
-        """
+        internal_location_ids = list(self.get_stock_locations())
+        product_id_list = list(map(int,product_ids))
 
-        internal_location_ids = tuple(self.get_stock_locations())
-        product_id_list = tuple(map(int,product_ids))
+        checkpoints = self.qp('get_products_available_as_of_checkpoints', """
+            SELECT DISTINCT ON (product_id)
+                    product_id,
+                    checkpoint_time,
+                    qty_available,
+                    virtual_available,
+                    incoming_qty,
+                    outgoing_qty
+            FROM
+                    zerp_product_qty_checkpoint
+            WHERE
+                    product_id = ANY($1::int[])
+                AND checkpoint_time <= $2
+            ORDER BY
+                    product_id, checkpoint_time desc
+        """,["int[]","timestamp"],[product_id_list, as_of])
 
-        counts = self.q("""
+        by_product_id = {}
+        since = {}
+        for product_id in product_id_list:
+            by_product_id[product_id] = self.empty_quantities()
+            since[product_id] = None
+        for checkpoint in checkpoints:
+            product_id = checkpoint['product_id']
+            for key in by_product_id[product_id]:
+                by_product_id[product_id][key] = checkpoint[key]
+            since[product_id] = checkpoint['checkpoint_time']
+
+        counts = self.qp(
+            'get_products_available_as_of_'+uom_convert_mode,
+            """
             SELECT
                                 c.product_id,
                                 direction,
-                                SUM(fn_uom_convert(c.product_uom,c.product_qty,pt.uom_id)) product_qty,
+                                SUM({converted_qty}) product_qty,
                                 c.state
             FROM (
-                                -- This query takes the various states and sums up the values
-                                -- of all the stock move lines
                                 select
-                                        SUM(product_qty) product_qty,
+                                        SUM(m.product_qty) product_qty,
                                         CASE
-                                            WHEN location_id NOT IN ({internal_location_ids})
+                                            WHEN src.location_id IS NULL
                                                 THEN 'in'
                                             ELSE 'out'
                                         END direction,
-                                        product_id,
-                                        product_uom,
-                                        state
+                                        m.product_id,
+                                        m.product_uom,
+                                        m.state
                                 from
-                                        stock_move
+                                        unnest($1::int[],$2::timestamp[]) p (product_id, since)
+                                join
+                                        stock_move m
+                                    on  m.product_id = p.product_id
+                                    and (p.since IS NULL OR m.date > p.since)
+                                    and m.date <= $3
+                                left join
+                                        unnest($4::int[]) src (location_id)
+                                    on  src.location_id = m.location_id
+                                left join
+                                        unnest($4::int[]) dst (location_id)
+                                    on  dst.location_id = m.location_dest_id
                                 where
-                                    (( -- incoming moves
-                                                location_id NOT IN ({internal_location_ids})
-                                            AND location_dest_id IN ({internal_location_ids})
-                                        )
-                                        OR
-                                     ( -- outgoing moves
-                                                location_id IN ({internal_location_ids})
-                                            AND location_dest_id NOT IN ({internal_location_ids})
-                                    ))
-                                    and product_id IN ({product_ids})
-                                    and state IN ('confirmed','waiting','assigned','done')
+                                        ( src.location_id IS NULL ) <> ( dst.location_id IS NULL )
+                                    and m.state IN ('confirmed','waiting','assigned','done')
                                 group by
-                                    product_id,
-                                    product_uom,
+                                    m.product_id,
+                                    m.product_uom,
                                     direction,
-                                    state
+                                    m.state
                             ) as c
                 LEFT JOIN
                             product_product pp
@@ -270,128 +2002,1001 @@ class IPLPY(izaber.plpython.base.IPLPY):
                 LEFT JOIN
                             product_template pt
                         ON  pt.id = pp.product_tmpl_id
+                LEFT JOIN
+                            product_uom fu
+                        ON  fu.id = c.product_uom
+                LEFT JOIN
+                            product_uom tu
+                        ON  tu.id = pt.uom_id
             GROUP BY
                 c.product_id, c.direction, c.state
-        """.format(
-            product_ids=",".join(map(str,product_id_list)),
-            internal_location_ids=",".join(map(str,internal_location_ids)),
-        ))
+            """.format(
+                converted_qty=UOM_CONVERT_EXPRESSIONS[uom_convert_mode]
+            ),
+            ["int[]","timestamp[]","timestamp","int[]"],
+            [
+                product_id_list,
+                [ since[product_id] for product_id in product_id_list ],
+                as_of,
+                internal_location_ids
+            ]
+        )
+
+        for count in counts:
+            self.add_quantity(
+                by_product_id[count['product_id']],
+                count['direction'],
+                count['state'],
+                count['product_qty']
+            )
+
+        return by_product_id
+
+    @instrumented
+    def create_checkpoints(self, checkpoint_time=None, product_ids=None, batch_size=500):
+        """ Records the quantities of the products (all of them by
+            default) as of checkpoint_time (now by default) for
+            get_products_available_as_of to start from. Meant to be run
+            periodically. As each run builds on the previous checkpoints
+            only the moves since then need to be gone through
+
+            Rather than blocking writes to stock_move, the checkpoints are
+            taken from just before the oldest transaction still in flight
+            (an earlier checkpoint_time is used as is). Moves those write
+            are dated after it, so they're left for the next run. Products
+            with moves being changed by an open transaction are skipped
+            this run as that change can't see the new checkpoints to
+            invalidate them. This needs READ COMMITTED so that each batch
+            sees the moves committed since the run started
+        """
+        isolation = self.qp('checkpoint_isolation', """
+            SELECT current_setting('transaction_isolation') isolation
+        """)[0]['isolation']
+        if isolation != 'read committed':
+            raise Exception("Checkpoints can't be created at isolation level '{}'".format(isolation))
+
+        checkpoint_time = self.qp('checkpoint_cutoff', """
+            SELECT
+                    LEAST(
+                        COALESCE($1, now()::timestamp),
+                        COALESCE(
+                            MIN(xact_start)::timestamp - interval '1 microsecond',
+                            now()::timestamp
+                        )
+                    ) checkpoint_time
+            FROM
+                    pg_stat_activity
+            WHERE
+                    xact_start IS NOT NULL
+                AND pid <> pg_backend_pid()
+        """,["timestamp"],[checkpoint_time])[0]['checkpoint_time']
+
+        if product_ids is None:
+            product_ids = [
+                row['id'] for row in self.qp('checkpoint_product_ids', """
+                    SELECT id FROM product_product ORDER BY id
+                """)
+            ]
+        else:
+            # Repeats would hit the same row twice in one ON CONFLICT
+            product_ids = sorted(set(map(int,product_ids)))
+
+        # From here on stock move changes have to invalidate checkpoints
+        self.set_setting('checkpoints', 1)
+
+        skipped = 0
+        for i in range(0, len(product_ids), batch_size):
+            batch = product_ids[i:i+batch_size]
+            busy_ids = set(
+                row['product_id'] for row in self.qp('checkpoint_busy_products', """
+                    SELECT DISTINCT
+                            m.product_id
+                    FROM
+                            stock_move m
+                    WHERE
+                            m.product_id = ANY($1::int[])
+                        AND m.xmax IN (
+                                SELECT backend_xid
+                                FROM pg_stat_activity
+                                WHERE backend_xid IS NOT NULL
+                            )
+                """,["int[]"],[batch])
+            )
+            if busy_ids:
+                skipped += len(busy_ids)
+                batch = [ product_id for product_id in batch if product_id not in busy_ids ]
+                if not batch:
+                    continue
+            results = self.get_products_available_as_of(batch, checkpoint_time)
+            self.qp('create_checkpoints', """
+                INSERT INTO zerp_product_qty_checkpoint
+                        (
+                            product_id, checkpoint_time,
+                            qty_available,
+                            virtual_available,
+                            incoming_qty,
+                            outgoing_qty
+                        )
+                SELECT
+                        product_id, $2,
+                        qty_available,
+                        virtual_available,
+                        incoming_qty,
+                        outgoing_qty
+                FROM
+                        unnest(
+                            $1::int[],
+                            $3::numeric[],
+                            $4::numeric[],
+                            $5::numeric[],
+                            $6::numeric[]
+                        ) AS v (
+                            product_id,
+                            qty_available,
+                            virtual_available,
+                            incoming_qty,
+                            outgoing_qty
+                        )
+                ON CONFLICT ( product_id, checkpoint_time ) DO UPDATE
+                SET
+                        qty_available = EXCLUDED.qty_available,
+                        virtual_available = EXCLUDED.virtual_available,
+                        incoming_qty = EXCLUDED.incoming_qty,
+                        outgoing_qty = EXCLUDED.outgoing_qty
+            """,
+            ["int[]","timestamp","numeric[]","numeric[]","numeric[]","numeric[]"],
+            [
+                batch,
+                checkpoint_time,
+                [ results[product_id]['qty_available'] for product_id in batch ],
+                [ results[product_id]['virtual_available'] for product_id in batch ],
+                [ results[product_id]['incoming_qty'] for product_id in batch ],
+                [ results[product_id]['outgoing_qty'] for product_id in batch ],
+            ])
+
+        return "Checkpointed {} product(s) as of {}, skipped {} busy".format(
+                    len(product_ids) - skipped, checkpoint_time, skipped
+                )
 
+    @instrumented
+    def invalidate_checkpoints(self, product_ids, since=None):
+        """ Removes the checkpoints of the products that were taken at or
+            after `since`, which may be a list matching product_ids. All
+            of them go when since is None
+        """
+        if not product_ids or not self.get_setting('checkpoints'):
+            return
+        product_ids = list(map(int,product_ids))
+        if not isinstance(since, (list, tuple)):
+            since = [ since ] * len(product_ids)
+        self.qp('invalidate_checkpoints', """
+            DELETE FROM zerp_product_qty_checkpoint c
+            USING
+                    unnest($1::int[],$2::timestamp[]) AS i (product_id, since)
+            WHERE
+                    c.product_id = i.product_id
+                AND (i.since IS NULL OR c.checkpoint_time >= i.since)
+        """,["int[]","timestamp[]"],[product_ids, list(since)])
+
+    @instrumented
+    def get_products_available_by_warehouse(self, product_ids, uom_convert_mode='sql'):
+        """ Returns a hash of product_id to a hash of warehouse_id to the
+            product quantities of that warehouse. Unlike the overall
+            figures, moves between two warehouses count as going out of
+            one and into the other
+        """
+        if uom_convert_mode not in UOM_CONVERT_MODES:
+            raise Exception("Unknown UoM conversion mode '{}'".format(uom_convert_mode))
+
+        locations = self.get_internal_locations()
+        location_ids = locations.ids
+        warehouse_ids = [ locations.warehouse_id(location_id) for location_id in location_ids ]
+        product_id_list = list(map(int,product_ids))
+
+        counts = self.qp(
+            'get_products_available_by_warehouse_'+uom_convert_mode,
+            """
+            SELECT
+                                c.product_id,
+                                c.source_warehouse_id,
+                                c.dest_warehouse_id,
+                                SUM({converted_qty}) product_qty,
+                                c.state
+            FROM (
+                                select
+                                        SUM(m.product_qty) product_qty,
+                                        src.warehouse_id source_warehouse_id,
+                                        dst.warehouse_id dest_warehouse_id,
+                                        m.product_id,
+                                        m.product_uom,
+                                        m.state
+                                from
+                                        stock_move m
+                                left join
+                                        unnest($2::int[],$3::int[]) src (location_id, warehouse_id)
+                                    on  src.location_id = m.location_id
+                                left join
+                                        unnest($2::int[],$3::int[]) dst (location_id, warehouse_id)
+                                    on  dst.location_id = m.location_dest_id
+                                where
+                                        src.warehouse_id IS DISTINCT FROM dst.warehouse_id
+                                    and m.product_id = ANY($1::int[])
+                                    and m.state IN ('confirmed','waiting','assigned','done')
+                                group by
+                                    m.product_id,
+                                    m.product_uom,
+                                    src.warehouse_id,
+                                    dst.warehouse_id,
+                                    m.state
+                            ) as c
+                LEFT JOIN
+                            product_product pp
+                        ON  pp.id = c.product_id
+                LEFT JOIN
+                            product_template pt
+                        ON  pt.id = pp.product_tmpl_id
+                LEFT JOIN
+                            product_uom fu
+                        ON  fu.id = c.product_uom
+                LEFT JOIN
+                            product_uom tu
+                        ON  tu.id = pt.uom_id
+            GROUP BY
+                c.product_id, c.source_warehouse_id, c.dest_warehouse_id, c.state
+            """.format(
+                converted_qty=UOM_CONVERT_EXPRESSIONS[uom_convert_mode]
+            ),
+            ["int[]","int[]","int[]"],
+            [product_id_list, location_ids, warehouse_ids]
+        )
 
         by_product_id = {}
         for product_id in product_id_list:
-            by_product_id[product_id] = {
-                                            'qty_available': 0,
-                                            'virtual_available': 0,
-                                            'incoming_qty': 0,
-                                            'outgoing_qty': 0,
-                                        }
+            by_product_id[product_id] = {}
 
         for count in counts:
-            product_id = count['product_id']
-            product_result = by_product_id[product_id]
+            warehouses = by_product_id[count['product_id']]
+            if count['source_warehouse_id'] is not None:
+                self.add_quantity(
+                    warehouses.setdefault(count['source_warehouse_id'], self.empty_quantities()),
+                    'out',
+                    count['state'],
+                    count['product_qty']
+                )
+            if count['dest_warehouse_id'] is not None:
+                self.add_quantity(
+                    warehouses.setdefault(count['dest_warehouse_id'], self.empty_quantities()),
+                    'in',
+                    count['state'],
+                    count['product_qty']
+                )
 
-            if count['direction'] == 'in':
-                quantity = count['product_qty']
-            else:
-                quantity = -count['product_qty']
+        return by_product_id
+
+    @instrumented
+    def rebuild_location_matrix(self, product_ids=None):
+        """ Recalculates the zerp_product_location_qty entries of
+            product_ids, or of every product, from stock_move
+        """
+        product_id_list = product_ids and list(map(int,product_ids)) or None
+        self.qp('rebuild_location_matrix_delete', """
+            DELETE FROM zerp_product_location_qty
+            WHERE       $1::int[] IS NULL OR product_id = ANY($1::int[])
+        """,["int[]"],[product_id_list])
+        self.qp('rebuild_location_matrix_insert', """
+            INSERT INTO zerp_product_location_qty
+                    ( product_id, location_id, product_uom, state, qty )
+            SELECT
+                    m.product_id, l.location_id, m.product_uom, m.state,
+                    SUM(l.qty)
+            FROM
+                    stock_move m
+            CROSS JOIN LATERAL (
+                    VALUES  ( m.location_dest_id, m.product_qty ),
+                            ( m.location_id, -m.product_qty )
+                ) l ( location_id, qty )
+            WHERE
+                    m.state IN ({states})
+                AND m.product_id IS NOT NULL
+                AND m.product_uom IS NOT NULL
+                AND l.location_id IS NOT NULL
+                AND ( $1::int[] IS NULL OR m.product_id = ANY($1::int[]) )
+            GROUP BY
+                    m.product_id, l.location_id, m.product_uom, m.state
+            HAVING
+                    SUM(l.qty) <> 0
+        """.format(
+            states=", ".join( "'{}'".format(state) for state in STOCK_MOVE_QTY_STATES )
+        ),["int[]"],[product_id_list])
+        return "OK"
+
+    @instrumented
+    def get_location_quantities(self, location_ids, product_ids=None, uom_convert_mode='sql'):
+        """ Returns a hash of each location id in location_ids to a hash
+            of product_id to the qty_available and virtual_available
+            within that location and all of the locations under it. Only
+            products with stock moved in or out of the location show up
+            unless product_ids is provided.
+
+            This reads from zerp_product_location_qty so the location
+            matrix must be turned on (see install_location_matrix)
+        """
+        if uom_convert_mode not in UOM_CONVERT_MODES:
+            raise Exception("Unknown UoM conversion mode '{}'".format(uom_convert_mode))
+        if not self.get_setting('location_matrix'):
+            raise Exception("The location matrix isn't installed")
+
+        location_id_list = list(map(int,location_ids))
+        product_id_list = product_ids is not None and list(map(int,product_ids)) or None
 
-            if count['state'] == 'done':
-                product_result['qty_available'] += quantity
-                product_result['virtual_available'] += quantity
+        counts = self.qp(
+            'get_location_quantities_'+uom_convert_mode,
+            """
+            SELECT
+                                c.root_id,
+                                c.product_id,
+                                c.state = 'done' done,
+                                SUM({converted_qty}) product_qty
+            FROM (
+                                -- Everything in the nested set range of each root
+                                select
+                                        root.id root_id,
+                                        m.product_id,
+                                        m.product_uom,
+                                        m.state,
+                                        SUM(m.qty) product_qty
+                                from
+                                        stock_location root
+                                join
+                                        stock_location sl
+                                    on  sl.parent_left >= root.parent_left
+                                    and sl.parent_left < root.parent_right
+                                join
+                                        zerp_product_location_qty m
+                                    on  m.location_id = sl.id
+                                where
+                                        root.id = ANY($1::int[])
+                                    and ( $2::int[] IS NULL OR m.product_id = ANY($2::int[]) )
+                                group by
+                                    root.id,
+                                    m.product_id,
+                                    m.product_uom,
+                                    m.state
+                            ) as c
+                LEFT JOIN
+                            product_product pp
+                        ON  pp.id = c.product_id
+                LEFT JOIN
+                            product_template pt
+                        ON  pt.id = pp.product_tmpl_id
+                LEFT JOIN
+                            product_uom fu
+                        ON  fu.id = c.product_uom
+                LEFT JOIN
+                            product_uom tu
+                        ON  tu.id = pt.uom_id
+            GROUP BY
+                c.root_id, c.product_id, c.state = 'done'
+            """.format(
+                converted_qty=UOM_CONVERT_EXPRESSIONS[uom_convert_mode]
+            ),
+            ["int[]","int[]"],
+            [location_id_list, product_id_list]
+        )
+
+        results = {}
+        for location_id in location_id_list:
+            results[location_id] = {}
+            for product_id in product_id_list or []:
+                results[location_id][product_id] = {
+                    'qty_available': 0,
+                    'virtual_available': 0,
+                }
 
+        for count in counts:
+            location_result = results[count['root_id']]
+            product_result = location_result.setdefault(count['product_id'],{
+                'qty_available': 0,
+                'virtual_available': 0,
+            })
+            product_result['virtual_available'] += count['product_qty']
+            if count['done']:
+                product_result['qty_available'] += count['product_qty']
+
+        return results
+
+    def empty_quantities(self):
+        # Decimal like the sums coming back from the numeric columns so
+        # that the values written out are all of one type
+        return {
+                    'qty_available': decimal.Decimal(0),
+                    'virtual_available': decimal.Decimal(0),
+                    'incoming_qty': decimal.Decimal(0),
+                    'outgoing_qty': decimal.Decimal(0),
+                }
+
+    def add_quantity(self, product_result, direction, state, product_qty):
+        """ Adds product_qty (in the product's UoM) moving in `direction`
+            ('in' or 'out' of our internal locations) while in `state`
+            to the quantities hash product_result
+        """
+        if direction == 'in':
+            quantity = product_qty
+        else:
+            quantity = -product_qty
+
+        if state == 'done':
+            product_result['qty_available'] += quantity
+            product_result['virtual_available'] += quantity
+
+        else:
+            product_result['virtual_available'] += quantity
+            if direction == 'out':
+                product_result['outgoing_qty'] += quantity
             else:
-                product_result['virtual_available'] += quantity
-                if count['direction'] == 'out':
-                    product_result['outgoing_qty'] += quantity
-                else:
-                    product_result['incoming_qty'] += quantity
+                product_result['incoming_qty'] += quantity
 
-        return by_product_id
+        return product_result
 
-    def get_product_available(self, product_id):
-        results = self.get_products_available([product_id])
+    def get_product_available(self, product_id, by_warehouse=False):
+        results = self.get_products_available([product_id], by_warehouse=by_warehouse)
         return pprint.pformat(results[product_id])
 
-    def sync_product_product_summary(self,ids=None):
+    def iter_products_available(self, product_ids=None, batch_size=PRODUCTS_AVAILABLE_BATCH_SIZE, uom_convert_mode='sql'):
+        """ Yields a zerp_product_quantities hash (product_id plus the
+            quantities) for each of product_ids or, if not provided, every
+            product. Only batch_size products are calculated at a time so
+            a whole catalogue can be streamed out of a set returning
+            function without holding all of it in memory
+        """
+        def batches():
+            if product_ids is not None:
+                product_id_list = list(map(int,product_ids))
+                for i in range(0, len(product_id_list), batch_size):
+                    yield product_id_list[i:i+batch_size]
+                return
+
+            plan = self.plan('iter_products_available_all', """
+                SELECT      id
+                FROM        product_product
+                ORDER BY    id
+            """)
+            cur = self.plpy.cursor(plan,[])
+            while True:
+                rows = cur.fetch(batch_size)
+                self.count_query(rows)
+                if not rows:
+                    break
+                yield [ row['id'] for row in rows ]
+            cur.close()
+
+        for batch in batches():
+            results = self.get_products_available(batch, uom_convert_mode)
+            for product_id in batch:
+                yield dict(results[product_id], product_id=product_id)
+
+    @instrumented
+    def sync_product_product_summary(self,ids=None,max_seconds=None,max_products=None):
         """ Clean up any dirty entries found in the summary table
             If ids are provided, we focus on just those ids. If not,
             we look at all the entries
         """
+        self.sync_dirty_products(ids, max_seconds, max_products)
+        return "OK"
+
+    @instrumented
+    def sync_dirty_products(self, ids=None, max_seconds=None, max_products=None):
+        """ Recalculates the dirty entries of the summary table (only
+            those in ids if provided), stopping once max_seconds have gone
+            by or max_products have been done. This allows a large backlog
+            to be worked through as a series of short transactions.
+
+            The batch size adapts so each batch takes roughly
+            SYNC_TARGET_BATCH_SECONDS and isn't going to run past the
+            deadline. Returns a hash of the products processed, those
+            still dirty, the seconds taken and the products per second
+        """
+        start = time.monotonic()
+        deadline = max_seconds and start + max_seconds or None
+        last_report = start
 
         # Deal with the dirty product counts
         # We will process in batches to reduce memory impact
-        where_cond = ''
+        #
+        # The rows are locked as they're fetched. A transaction that
+        # changes one of the products while we recalculate it then waits
+        # for us to write the clean values before flagging it dirty again
+        # rather than its flag being overwritten by our (older) values.
+        # Whereas one that got there first has committed its moves by the
+        # time we get the lock and recalculate
         if ids:
-            where_cond = 'AND product_id in ({})'.format(",".join(map(str,ids)))
-        cur = self.plpy.cursor("""
+            plan = self.plan('sync_dirty_products_by_id', """
                     SELECT  product_id
-                    FROM (
-                            SELECT DISTINCT ON (product_id) product_id, dirty
-                            FROM zerp_product_dirty_log
-                            ORDER BY product_id, update_time desc, dirty desc
-                        ) a
+                    FROM    zerp_product_summary
                     WHERE
-                            dirty = 't'
-                            {where_cond}
+                            dirty
+                        AND product_id = ANY($1::int[])
+                    ORDER BY product_id
+                    FOR UPDATE
                     ;
-                """.format(where_cond=where_cond))
+                """,["int[]"])
+            cur = self.plpy.cursor(plan,[list(map(int,ids))])
+        else:
+            plan = self.plan('sync_dirty_products', """
+                    SELECT  product_id
+                    FROM    zerp_product_summary
+                    WHERE
+                            dirty
+                    ORDER BY product_id
+                    FOR UPDATE
+                    ;
+                """)
+            cur = self.plpy.cursor(plan,[])
+
+        processed = 0
+        batch_size = SYNC_INITIAL_BATCH_SIZE
         while True:
-            rows = cur.fetch(100)
+            if max_products is not None:
+                batch_size = min(batch_size, max_products - processed)
+            if batch_size <= 0:
+                break
+            if deadline and time.monotonic() >= deadline:
+                break
+
+            rows = cur.fetch(batch_size)
+            self.count_query(rows)
             if not rows:
                 break
-            self.plpy.info("Syncing {} record(s)...".format(len(rows)))
+
+            batch_start = time.monotonic()
             product_ids = list(map(lambda a:a['product_id'], rows))
-            product_counts = self.get_products_available(product_ids)
-            self.GD['product_counts'] = product_counts
+            self.sync_products(product_ids)
+            now = time.monotonic()
+            processed += len(rows)
+
+            # Size the next batch to take about the target time, growing
+            # no faster than doubling, and to fit in what's left of the
+            # time budget
+            per_product = ( now - batch_start ) / len(rows)
+            if per_product > 0:
+                batch_size = int(SYNC_TARGET_BATCH_SECONDS / per_product)
+                if deadline:
+                    batch_size = min(batch_size, int(( deadline - now ) / per_product))
+            else:
+                batch_size = len(rows) * 2
+            batch_size = max(
+                            SYNC_MIN_BATCH_SIZE,
+                            min(batch_size, len(rows) * 2, SYNC_MAX_BATCH_SIZE)
+                        )
 
-            for product_id,vals in product_counts.items():
-                self.q("""
-                    INSERT INTO zerp_product_dirty_log
-                            (
-                                product_id, update_time, dirty,
-                                cached_qty_available,
-                                cached_virtual_available,
-                                cached_incoming_qty,
-                                cached_outgoing_qty
-                            )
-                    VALUES  (
-                                {product_id}, now(), 'f',
-                                {qty_available},
-                                {virtual_available},
-                                {incoming_qty},
-                                {outgoing_qty}
-                    )
-                """.format(
-                    product_id=product_id,
-                    **vals
+            if now - last_report >= SYNC_PROGRESS_INTERVAL:
+                last_report = now
+                self.plpy.info("Synced {} record(s) at {:.0f}/s...".format(
+                    processed,
+                    processed / ( now - start )
                 ))
+        cur.close()
 
-        return "OK"
+        if ids:
+            data = self.qp('sync_dirty_products_remaining_by_id', """
+                SELECT  COUNT(*) remaining
+                FROM    zerp_product_summary
+                WHERE
+                        dirty
+                    AND product_id = ANY($1::int[])
+            """,["int[]"],[list(map(int,ids))])
+        else:
+            data = self.qp('sync_dirty_products_remaining', """
+                SELECT  COUNT(*) remaining
+                FROM    zerp_product_summary
+                WHERE
+                        dirty
+            """)
+
+        seconds = time.monotonic() - start
+        return {
+            'processed': processed,
+            'remaining': data[0]['remaining'],
+            'seconds': seconds,
+            'rate': seconds and processed / seconds or 0,
+        }
+
+    @instrumented
+    def sync_products(self, product_ids):
+        """ Recalculates the quantities of product_ids and stores them
+            as clean values
+        """
+        product_counts = self.get_products_available(product_ids)
+        self.write_product_counts(product_counts)
+        return product_counts
+
+    @instrumented
+    def get_cached_products_available(self, product_ids, max_age=0):
+        """ Returns a hash of product_id to the stored quantities of each
+            product along with its dirty flag and update_time. Products
+            without an entry are left out.
+
+            Results are remembered in a per backend LRU of up to
+            CACHED_PRODUCTS_LRU_SIZE products. Entries no older than
+            max_age seconds are served from there without going to the
+            database. The default of 0 always reads fresh values
+        """
+        lru = self.GD.get('cached_products_lru')
+        if lru is None:
+            lru = self.GD['cached_products_lru'] = collections.OrderedDict()
+
+        now = time.monotonic()
+        results = {}
+        missing_ids = []
+        for product_id in map(int,product_ids):
+            entry = max_age and lru.get(product_id)
+            if entry and now - entry[0] <= max_age:
+                lru.move_to_end(product_id)
+                results[product_id] = entry[1]
+            else:
+                missing_ids.append(product_id)
+        self.count_event('cached_products_lru.hit', len(results))
+        self.count_event('cached_products_lru.miss', len(missing_ids))
+
+        if missing_ids:
+            data = self.qp('get_cached_products_available', """
+                SELECT
+                        product_id,
+                        update_time,
+                        dirty,
+                        cached_qty_available,
+                        cached_virtual_available,
+                        cached_incoming_qty,
+                        cached_outgoing_qty
+                FROM
+                        zerp_product_summary
+                WHERE
+                        product_id = ANY($1::int[])
+            """,["int[]"],[missing_ids])
+
+            for row in data:
+                product_result = {
+                    'product_id': row['product_id'],
+                    'update_time': row['update_time'],
+                    'dirty': row['dirty'],
+                }
+                for column, key in CACHED_QUANTITY_COLUMNS:
+                    product_result[key] = row[column]
+                results[row['product_id']] = product_result
+                lru[row['product_id']] = ( now, product_result )
+                lru.move_to_end(row['product_id'])
+
+            while len(lru) > CACHED_PRODUCTS_LRU_SIZE:
+                lru.popitem(last=False)
+
+        return results
+
+    @instrumented
+    def get_fresh_products_available(self, product_ids, max_staleness=None):
+        """ Like get_cached_products_available but any product that's
+            dirty, missing from the summary or, with max_staleness, was
+            last calculated more than max_staleness seconds ago gets
+            recalculated and written back first.
+
+            The stale rows are locked while they're recalculated. A
+            concurrent reader of the same products waits for the lock and
+            then finds them fresh so only one of them does the work. That
+            relies on READ COMMITTED rechecking the rows once the lock is
+            released
+        """
+        product_id_list = sorted(set(map(int,product_ids)))
+
+        data = self.qp('lock_stale_products', """
+            SELECT  product_id
+            FROM    zerp_product_summary
+            WHERE
+                    product_id = ANY($1::int[])
+                AND (
+                        dirty
+                    OR  (
+                                $2::float8 IS NOT NULL
+                            AND update_time < now() - make_interval(secs => $2::float8)
+                        )
+                )
+            ORDER BY product_id
+            FOR UPDATE
+        """,["int[]","float8"],[product_id_list, max_staleness])
+        stale_ids = set( row['product_id'] for row in data )
+
+        # Products marked dirty earlier in this transaction that are still
+        # waiting for the commit to be flagged (see defer_dirty_products)
+        pending = self.GD.get('pending_dirty_products')
+        if pending:
+            # A set left behind by a transaction that was rolled back
+            # doesn't count. A transaction that queued anything has been
+            # assigned an id so there's no need to force one
+            txid = self.qp('current_txid_if_assigned', """
+                SELECT txid_current_if_assigned() txid
+            """)[0]['txid']
+            if pending[0] == txid:
+                stale_ids.update(pending[1].intersection(product_id_list))
+
+        if stale_ids:
+            self.sync_products(sorted(stale_ids))
+
+        results = self.get_cached_products_available(product_id_list)
+
+        missing_ids = [
+            product_id
+            for product_id in product_id_list
+            if product_id not in results
+        ]
+        if missing_ids:
+            # Only products that exist get a summary row
+            missing_ids = [
+                row['id'] for row in self.qp('get_fresh_products_existing', """
+                    SELECT id FROM product_product WHERE id = ANY($1::int[]) ORDER BY id
+                """,["int[]"],[missing_ids])
+            ]
+        if missing_ids:
+            self.sync_products(missing_ids)
+            results.update(self.get_cached_products_available(missing_ids))
+
+        return results
+
+    def forget_cached_products(self, product_ids):
+        """ Drops the products from this backend's LRU after we've
+            changed them
+        """
+        lru = self.GD.get('cached_products_lru')
+        if not lru:
+            return
+        for product_id in product_ids:
+            lru.pop(product_id, None)
+
+    @instrumented
+    def claim_dirty_products(self, batch_size=100, shards=1, shard=0):
+        """ Locks and returns up to batch_size dirty product ids. Rows
+            already locked by another session are skipped so concurrent
+            callers always get disjoint batches. The locks are held until
+            the end of the transaction
+
+            With shards, only the products where product_id % shards
+            equals shard are considered so that each caller keeps to its
+            own part of the product id space
+        """
+        data = self.qp('claim_dirty_products', """
+            SELECT  product_id
+            FROM    zerp_product_summary
+            WHERE
+                    dirty
+                AND product_id % $2 = $3
+            ORDER BY product_id
+            LIMIT   $1
+            FOR UPDATE SKIP LOCKED
+        """,["int","int","int"],[batch_size, shards, shard])
+        return [ row['product_id'] for row in data ]
+
+    @instrumented
+    def sync_product_product_summary_worker(self, batch_size=100, shards=1, shard=0):
+        """ Claims one batch of dirty products and recalculates them.
+            Meant to be called repeatedly, each in its own transaction,
+            from any number of sessions at once. Returns the number of
+            products synced, 0 once there's nothing left to claim
+        """
+        product_ids = self.claim_dirty_products(batch_size, shards, shard)
+        if product_ids:
+            self.sync_products(product_ids)
+        return len(product_ids)
+
+    def run_sync_product_product_summary_worker(self, batch_size=100, max_batches=None, shards=1, shard=0):
+        """ Keeps calling sync_product_product_summary_worker, committing
+            after every batch, until no dirty products are left or
+            max_batches have been done. Only usable from a procedure or
+            through the adapter (see izaber.plpython.zerp.adapter)
+        """
+        synced = 0
+        batches = 0
+        while not max_batches or batches < max_batches:
+            count = self.sync_product_product_summary_worker(batch_size, shards, shard)
+            self.plpy.commit()
+
+            # Locations, UoMs or settings may have been changed by the
+            # transactions that committed while we were working
+            self.reset_call_state()
+            if not count:
+                break
+            synced += count
+            batches += 1
+        return synced
+
+    @instrumented
+    def write_product_counts(self, product_counts):
+        """ Records the freshly calculated quantities as clean values.
+            product_counts is the hash returned by get_products_available
+            and the whole batch goes out as one statement that unnests
+            parallel arrays of the values
+        """
+        if not product_counts:
+            return
 
+        self.forget_cached_products(product_counts)
+
+        product_ids = []
+        qty_available = []
+        virtual_available = []
+        incoming_qty = []
+        outgoing_qty = []
+        for product_id,vals in product_counts.items():
+            product_ids.append(product_id)
+            qty_available.append(vals['qty_available'])
+            virtual_available.append(vals['virtual_available'])
+            incoming_qty.append(vals['incoming_qty'])
+            outgoing_qty.append(vals['outgoing_qty'])
+
+        self.qp('write_product_counts', """
+            INSERT INTO zerp_product_summary
+                    (
+                        product_id, update_time, dirty,
+                        cached_qty_available,
+                        cached_virtual_available,
+                        cached_incoming_qty,
+                        cached_outgoing_qty
+                    )
+            SELECT
+                    product_id, now(), False,
+                    qty_available,
+                    virtual_available,
+                    incoming_qty,
+                    outgoing_qty
+            FROM
+                    unnest(
+                        $1::int[],
+                        $2::numeric[],
+                        $3::numeric[],
+                        $4::numeric[],
+                        $5::numeric[]
+                    ) AS v (
+                        product_id,
+                        qty_available,
+                        virtual_available,
+                        incoming_qty,
+                        outgoing_qty
+                    )
+            ON CONFLICT ( product_id ) DO UPDATE
+            SET
+                    update_time = EXCLUDED.update_time,
+                    dirty = EXCLUDED.dirty,
+                    cached_qty_available = EXCLUDED.cached_qty_available,
+                    cached_virtual_available = EXCLUDED.cached_virtual_available,
+                    cached_incoming_qty = EXCLUDED.cached_incoming_qty,
+                    cached_outgoing_qty = EXCLUDED.cached_outgoing_qty
+        """,
+        ["int[]","numeric[]","numeric[]","numeric[]","numeric[]"],
+        [
+            product_ids,
+            qty_available,
+            virtual_available,
+            incoming_qty,
+            outgoing_qty,
+        ])
+
+    @instrumented
     def mark_products_dirty(self,dirty_product_ids):
+        """ Flags the products as requiring their quantities to be
+            recalculated. With the 'coalesce_dirty' setting on, the ids are
+            held until the transaction commits (see defer_dirty_products)
+            otherwise they're written immediately
+        """
         if not dirty_product_ids:
             return
-        for product_id in dirty_product_ids:
-            self.q("""
-                INSERT INTO zerp_product_dirty_log
-                        (
-                            product_id, update_time, dirty,
-                            cached_qty_available,
-                            cached_virtual_available,
-                            cached_incoming_qty,
-                            cached_outgoing_qty
-                        )
-                        VALUES
-                        (
-                            {product_id}, now(), True,
-                            0, 0, 0, 0
-                        )
-            """.format(
-                product_id=product_id
-            ))
-
-
+        self.forget_cached_products(dirty_product_ids)
+        if self.get_setting('coalesce_dirty'):
+            self.defer_dirty_products(dirty_product_ids)
+        else:
+            self.write_dirty_products(dirty_product_ids)
+
+    def defer_dirty_products(self, dirty_product_ids):
+        """ Adds the products to the set of ids to flag as dirty when the
+            current transaction commits. The set lives in GD along with
+            the transaction id so anything left behind by a transaction
+            that was rolled back gets thrown away.
+
+            A row queued in zerp_product_dirty_queue is what gets the
+            deferred trig_zerp_product_dirty_flush to fire at commit. It's
+            queued again if it was lost to a rolled back savepoint. Note
+            that until the commit the products don't show as dirty, even
+            to this transaction
+        """
+        data = self.qp('current_txid_queued', """
+            SELECT  txid_current() txid,
+                    EXISTS (
+                        SELECT  1
+                        FROM    zerp_product_dirty_queue
+                        WHERE   txid = txid_current()
+                    ) queued
+        """)
+        txid = data[0]['txid']
+
+        pending = self.GD.get('pending_dirty_products')
+        if pending is None or pending[0] != txid:
+            pending = self.GD['pending_dirty_products'] = ( txid, set() )
+        if not data[0]['queued']:
+            self.qp('queue_dirty_products_flush', """
+                INSERT INTO zerp_product_dirty_queue ( txid ) VALUES ( $1 )
+            """,["bigint"],[txid])
+        pending[1].update(map(int,dirty_product_ids))
+
+    @instrumented
+    def trigger_flush_dirty_products(self):
+        """ Deferred trigger on zerp_product_dirty_queue that writes out
+            the products collected by defer_dirty_products in one go
+        """
+        txid = self.TD['new']['txid']
+        pending = self.GD.pop('pending_dirty_products',None)
+
+        self.qp('dequeue_dirty_products_flush', """
+            DELETE FROM zerp_product_dirty_queue WHERE txid = $1
+        """,["bigint"],[txid])
+
+        # Sorted so concurrent transactions lock the rows in the same
+        # order
+        if pending and pending[0] == txid:
+            self.write_dirty_products(sorted(pending[1]))
+
+    @instrumented
+    def write_dirty_products(self, dirty_product_ids):
+        """ Flags the products as dirty. All the ids are written with a
+            single statement. The last known quantities are left in place
+            and products that are already dirty aren't touched
+        """
+        if not dirty_product_ids:
+            return
+        self.forget_cached_products(dirty_product_ids)
+        data = self.qp('mark_products_dirty', """
+            INSERT INTO zerp_product_summary
+                    (
+                        product_id, update_time, dirty,
+                        cached_qty_available,
+                        cached_virtual_available,
+                        cached_incoming_qty,
+                        cached_outgoing_qty
+                    )
+            SELECT  DISTINCT
+                    product_id, now(), True,
+                    0, 0, 0, 0
+            FROM
+                    unnest($1::int[]) product_id
+            ON CONFLICT ( product_id ) DO UPDATE
+            SET
+                    update_time = EXCLUDED.update_time,
+                    dirty = True
+            WHERE
+                    NOT zerp_product_summary.dirty
+            RETURNING
+                    product_id
+        """,["int[]"],[list(map(int,dirty_product_ids))])
+
+        if self.get_setting('notify_dirty'):
+            self.notify_products_dirty([ row['product_id'] for row in data ])
+
+    @instrumented
+    def notify_products_dirty(self, product_ids):
+        """ Sends the product ids out on NOTIFY_CHANNEL. The notifications
+            are delivered when the transaction commits
+        """
+        payloads = []
+        payload = ''
+        for product_id in product_ids:
+            product_id = str(product_id)
+            if payload and len(payload) + len(product_id) + 1 > NOTIFY_MAX_PAYLOAD:
+                payloads.append(payload)
+                payload = ''
+            payload = payload and payload + ',' + product_id or product_id
+        if payload:
+            payloads.append(payload)
+
+        for payload in payloads:
+            self.qp('notify_products_dirty', """
+                SELECT pg_notify($1, $2)
+            """,["text","text"],[NOTIFY_CHANNEL, payload])
+
+    @instrumented
     def trigger_stock_move_changes(self):
         """ This trigger should execute when a stock.move is created.
             The purpose of this function is to flag in the
@@ -400,12 +3005,338 @@ class IPLPY(izaber.plpython.base.IPLPY):
         """
         old = self.TD['old'] or {}
         new = self.TD['new'] or {}
+
+        self.invalidate_stock_move_checkpoints(old, new)
+        if not self.stock_move_quantity_changed(old, new):
+            return
+
         dirty_product_ids = []
         for product_id in [ old.get('product_id'), new.get('product_id') ]:
             if not product_id: continue
             dirty_product_ids.append(product_id)
         self.mark_products_dirty(dirty_product_ids)
 
+    def stock_move_quantity_changed(self, old, new):
+        """ Returns False if the stock.move update left all the columns
+            that matter to the quantities alone
+        """
+        if not ( old and new ):
+            return True
+        for column in STOCK_MOVE_QTY_COLUMNS:
+            if old.get(column) != new.get(column):
+                return True
+        return False
+
+    def invalidate_stock_move_checkpoints(self, old, new):
+        """ A change to a stock.move invalidates the checkpoints of its
+            product taken since the move's date
+        """
+        if old and new \
+           and not self.stock_move_quantity_changed(old, new) \
+           and old.get('date') == new.get('date'):
+                return
+
+        product_ids = []
+        since = []
+        for move in [ old, new ]:
+            if not move.get('product_id'): continue
+            product_ids.append(move['product_id'])
+            since.append(move.get('date'))
+        self.invalidate_checkpoints(product_ids, since)
+
+    def get_product_uom_ids(self, product_ids):
+        """ Returns a hash of product_id to the product's default UoM id
+        """
+        data = self.qp('get_product_uom_ids', """
+            SELECT
+                    pp.id product_id,
+                    pt.uom_id
+            FROM
+                    product_product pp
+            JOIN
+                    product_template pt
+                ON  pt.id = pp.product_tmpl_id
+            WHERE
+                    pp.id = ANY($1::int[])
+        """,["int[]"],[list(map(int,product_ids))])
+        return { row['product_id']: row['uom_id'] for row in data }
+
+    def stock_move_direction(self, move):
+        """ Returns 'in' or 'out' if the stock.move row crosses the
+            boundary of our internal locations, None otherwise
+        """
+        internal_location_ids = self.get_internal_locations()
+
+        source_internal = move.get('location_id') in internal_location_ids
+        dest_internal = move.get('location_dest_id') in internal_location_ids
+        if not source_internal and dest_internal:
+            return 'in'
+        if source_internal and not dest_internal:
+            return 'out'
+        return None
+
+    @instrumented
+    def stock_move_deltas(self, old, new):
+        """ Works out how replacing the stock.move row `old` with `new`
+            changes the cached quantities. Either may be empty for
+            inserts and deletes.
+
+            Returns a tuple of ( deltas, unreliable_product_ids ) where
+            deltas is a hash of product_id to quantity changes and
+            unreliable_product_ids lists products whose change could not
+            be worked out exactly and need a full recompute instead. That
+            includes any move not in the product's UoM: converting each
+            move on its own would round differently from the full
+            recompute, which converts the summed quantities
+        """
+        moves = []
+        for move, sign in [ ( old, -1 ), ( new, 1 ) ]:
+            if not move.get('product_id'):
+                continue
+            if move.get('state') not in STOCK_MOVE_QTY_STATES:
+                continue
+            direction = self.stock_move_direction(move)
+            if not direction:
+                continue
+            moves.append(( move, sign, direction ))
+
+        deltas = {}
+        unreliable_product_ids = []
+        if not moves:
+            return deltas, unreliable_product_ids
+
+        product_uom_ids = self.get_product_uom_ids(
+                                [ move['product_id'] for move, sign, direction in moves ]
+                            )
+        for move, sign, direction in moves:
+            product_id = move['product_id']
+            move_uom_id = move.get('product_uom')
+            product_uom_id = product_uom_ids.get(product_id)
+            if move_uom_id and product_uom_id and move_uom_id != product_uom_id:
+                unreliable_product_ids.append(product_id)
+                continue
+            product_qty = move['product_qty'] or 0
+            product_result = deltas.setdefault(product_id, self.empty_quantities())
+            self.add_quantity(product_result, direction, move['state'], sign * product_qty)
+
+        for product_id in unreliable_product_ids:
+            deltas.pop(product_id, None)
+
+        return deltas, unreliable_product_ids
+
+    @instrumented
+    def apply_product_deltas(self, deltas):
+        """ Adds the quantity changes in deltas (product_id to changes) to
+            the current cached values of each product. Products that
+            are dirty are skipped as they will be fully recalculated on
+            the next sync anyway.
+
+            Returns the list of product_ids the deltas could not be
+            applied to
+        """
+        if not deltas:
+            return []
+
+        product_ids = sorted(deltas)
+        self.forget_cached_products(product_ids)
+
+        # Updating in place takes the row lock so concurrent transactions
+        # each add their delta on top of the other's
+        applied = self.qp('apply_product_deltas', """
+            UPDATE  zerp_product_summary s
+            SET
+                    update_time = now(),
+                    cached_qty_available = s.cached_qty_available + d.qty_available,
+                    cached_virtual_available = s.cached_virtual_available + d.virtual_available,
+                    cached_incoming_qty = s.cached_incoming_qty + d.incoming_qty,
+                    cached_outgoing_qty = s.cached_outgoing_qty + d.outgoing_qty
+            FROM
+                    unnest(
+                        $1::int[],
+                        $2::numeric[],
+                        $3::numeric[],
+                        $4::numeric[],
+                        $5::numeric[]
+                    ) AS d (
+                        product_id,
+                        qty_available,
+                        virtual_available,
+                        incoming_qty,
+                        outgoing_qty
+                    )
+            WHERE
+                    s.product_id = d.product_id
+                AND NOT s.dirty
+            RETURNING
+                    s.product_id
+        """,
+        ["int[]","numeric[]","numeric[]","numeric[]","numeric[]"],
+        [
+            product_ids,
+            [ deltas[product_id]['qty_available'] for product_id in product_ids ],
+            [ deltas[product_id]['virtual_available'] for product_id in product_ids ],
+            [ deltas[product_id]['incoming_qty'] for product_id in product_ids ],
+            [ deltas[product_id]['outgoing_qty'] for product_id in product_ids ],
+        ])
+
+        applied_product_ids = set( row['product_id'] for row in applied )
+        return [
+            product_id for product_id in product_ids
+            if product_id not in applied_product_ids
+        ]
+
+    @instrumented
+    def trigger_stock_move_delta(self):
+        """ Incremental version of trigger_stock_move_changes. Rather than
+            flagging the product for a full recompute, the signed
+            contribution of the old and new stock.move rows is applied
+            directly to the product's cached quantities
+        """
+        old = self.TD['old'] or {}
+        new = self.TD['new'] or {}
+
+        self.invalidate_stock_move_checkpoints(old, new)
+        if not self.stock_move_quantity_changed(old, new):
+            return
+
+        deltas, unreliable_product_ids = self.stock_move_deltas(old, new)
+
+        # Products without a clean cached entry to apply the delta to
+        # (already dirty or never seen before) get a full recompute
+        unreliable_product_ids += self.apply_product_deltas(deltas)
+        self.mark_products_dirty(unreliable_product_ids)
+
+    @instrumented
+    def trigger_stock_move_changes_statement(self):
+        """ Statement level version of trigger_stock_move_changes. Rather
+            than being invoked once per stock.move row, this is invoked
+            once per INSERT/UPDATE/DELETE statement and works out the
+            set of affected products from the transition tables
+        """
+        event = self.TD['event']
+
+        # Each query returns the affected products, whether their
+        # quantities need recalculating and the earliest move date
+        # involved for invalidating checkpoints
+        if event == 'INSERT':
+            query = """
+                SELECT  product_id,
+                        True dirty,
+                        MIN(date) since
+                FROM    zerp_stock_move_new
+                WHERE   product_id IS NOT NULL
+                GROUP BY product_id
+            """
+        elif event == 'DELETE':
+            query = """
+                SELECT  product_id,
+                        True dirty,
+                        MIN(date) since
+                FROM    zerp_stock_move_old
+                WHERE   product_id IS NOT NULL
+                GROUP BY product_id
+            """
+        else:
+            # Only the moves where a quantity related column (or the date
+            # for the checkpoints) has changed are of interest to us
+            query = """
+                SELECT  product_id,
+                        bool_or(quantity_changed) dirty,
+                        MIN(date) since
+                FROM (
+                        SELECT  unnest(ARRAY[o.product_id, n.product_id]) product_id,
+                                unnest(ARRAY[o.date, n.date]) date,
+                                (
+                                    o.product_uom, o.product_qty,
+                                    o.location_id, o.location_dest_id,
+                                    o.product_id, o.state
+                                )
+                                IS DISTINCT FROM
+                                (
+                                    n.product_uom, n.product_qty,
+                                    n.location_id, n.location_dest_id,
+                                    n.product_id, n.state
+                                ) quantity_changed
+                        FROM    zerp_stock_move_old o
+                        JOIN    zerp_stock_move_new n
+                        ON      n.id = o.id
+                        WHERE   (
+                                    o.product_uom, o.product_qty,
+                                    o.location_id, o.location_dest_id,
+                                    o.product_id, o.state, o.date
+                                )
+                                IS DISTINCT FROM
+                                (
+                                    n.product_uom, n.product_qty,
+                                    n.location_id, n.location_dest_id,
+                                    n.product_id, n.state, n.date
+                                )
+                    ) changed
+                WHERE   product_id IS NOT NULL
+                GROUP BY product_id
+            """
+
+        # Transition tables only exist for the duration of this trigger
+        # call so these queries can't go into the plan cache
+        data = self.q(query)
+        self.invalidate_checkpoints(
+            [ row['product_id'] for row in data ],
+            [ row['since'] for row in data ]
+        )
+        self.mark_products_dirty([ row['product_id'] for row in data if row['dirty'] ])
+
+    @instrumented
+    def trigger_stock_move_location_matrix(self):
+        """ Statement trigger on stock_move that applies the change in
+            quantities the statement made to zerp_product_location_qty.
+            Each move adds its quantity to its destination location and
+            takes it from its source location. For the old rows the signs
+            are reversed
+        """
+        event = self.TD['event']
+
+        deltas = []
+        if event in ( 'INSERT', 'UPDATE' ):
+            deltas.append(( 'zerp_stock_move_new', 1 ))
+        if event in ( 'UPDATE', 'DELETE' ):
+            deltas.append(( 'zerp_stock_move_old', -1 ))
+
+        moves = " UNION ALL ".join("""
+            SELECT  product_id, location_dest_id location_id, product_uom, state,
+                    {sign} * product_qty qty
+            FROM    {table}
+            UNION ALL
+            SELECT  product_id, location_id, product_uom, state,
+                    {sign} * -product_qty qty
+            FROM    {table}
+        """.format(table=table, sign=sign) for table, sign in deltas)
+
+        # Transition tables only exist for the duration of this trigger
+        # call so this query can't go into the plan cache
+        self.q("""
+            INSERT INTO zerp_product_location_qty AS plq
+                    ( product_id, location_id, product_uom, state, qty )
+            SELECT
+                    product_id, location_id, product_uom, state,
+                    SUM(qty)
+            FROM    ( {moves} ) m
+            WHERE
+                    state IN ({states})
+                AND product_id IS NOT NULL
+                AND product_uom IS NOT NULL
+                AND location_id IS NOT NULL
+            GROUP BY
+                    product_id, location_id, product_uom, state
+            HAVING
+                    SUM(qty) <> 0
+            ON CONFLICT ( product_id, location_id, product_uom, state ) DO UPDATE
+            SET     qty = plq.qty + EXCLUDED.qty
+        """.format(
+            moves=moves,
+            states=", ".join( "'{}'".format(state) for state in STOCK_MOVE_QTY_STATES )
+        ))
+
+    @instrumented
     def trigger_location_changes(self):
         """ This trigger should execute when a location is changed
             The purpose of this function is to flag in the
@@ -415,24 +3346,59 @@ class IPLPY(izaber.plpython.base.IPLPY):
         old = self.TD['old'] or {}
         new = self.TD['new'] or {}
 
-        # Go through the stock_move list for any changes that might
-        data = self.q("""
-            SELECT  DISTINCT product_id
-            FROM    stock_move
-            WHERE
-                    location_id = {location_id}
-                OR  location_dest_id = {location_id}
-        """.format(
-            location_id = old.get('id')
-        ))
+        # The set of internal locations may well have changed so every
+        # backend needs to reload it
+        self.bump_cache_generation('stock_locations')
+
+        # The whole subtree under the location goes along with it so
+        # every location within it, by both the old and new nested set
+        # ranges, is affected. The ORM only renumbers parent_left and
+        # parent_right after the fact so they're often the same here
+        ranges = []
+        for rec in ( old, new ):
+            if rec.get('parent_left') is None or rec.get('parent_right') is None:
+                continue
+            location_range = [ rec['parent_left'], rec['parent_right'] ]
+            if location_range not in ranges:
+                ranges.append(location_range)
+        while len(ranges) < 2:
+            ranges.append([ None, None ])
+
+        # Go through the stock_move list for any products moved in or
+        # out of the subtree. Both halves are served by the
+        # ndx_zerp_stock_move_location*_product indexes
+        data = self.qp('trigger_location_changes', """
+            WITH subtree AS (
+                SELECT  id
+                FROM    stock_location
+                WHERE   id = $1
+                    OR  ( parent_left >= $2 AND parent_left < $3 )
+                    OR  ( parent_left >= $4 AND parent_left < $5 )
+            )
+            SELECT  sm.product_id
+            FROM    subtree
+            JOIN    stock_move sm
+            ON      sm.location_id = subtree.id
+            UNION
+            SELECT  sm.product_id
+            FROM    subtree
+            JOIN    stock_move sm
+            ON      sm.location_dest_id = subtree.id
+        """,["int","int","int","int","int"],[
+            old.get('id') or new.get('id'),
+            ranges[0][0], ranges[0][1],
+            ranges[1][0], ranges[1][1],
+        ])
 
         dirty_product_ids = []
         for row in data:
             product_id = row['product_id']
             if not product_id: continue
             dirty_product_ids.append(product_id)
+        self.invalidate_checkpoints(dirty_product_ids)
         self.mark_products_dirty(dirty_product_ids)
 
+    @instrumented
     def trigger_uom_changes(self):
         """ This trigger should execute when a uom is changed
             The purpose of this function is to flag in the
@@ -442,23 +3408,34 @@ class IPLPY(izaber.plpython.base.IPLPY):
         old = self.TD['old'] or {}
         new = self.TD['new'] or {}
 
-        # Go through the stock_move list for any changes that might
-        data = self.q("""
+        # Every backend needs to reload its copy of the UoM table
+        self.bump_cache_generation('uom')
+
+        # Go through the stock_move list for any changes that might as
+        # well as the products whose quantities are kept in this UoM
+        data = self.qp('trigger_uom_changes', """
             SELECT  DISTINCT product_id
             FROM    stock_move
             WHERE
-                    product_uom = {uom_id}
-        """.format(
-            uom_id = old.get('id')
-        ))
+                    product_uom = $1
+            UNION
+            SELECT  pp.id
+            FROM    product_product pp
+            JOIN    product_template pt
+            ON      pt.id = pp.product_tmpl_id
+            WHERE
+                    pt.uom_id = $1
+        """,["int"],[old.get('id')])
 
         dirty_product_ids = []
         for row in data:
             product_id = row['product_id']
             if not product_id: continue
             dirty_product_ids.append(product_id)
+        self.invalidate_checkpoints(dirty_product_ids)
         self.mark_products_dirty(dirty_product_ids)
 
+    @instrumented
     def trigger_product_changes(self):
         """ This trigger should execute when a product is changed.
             The purpose of this function is to flag in the
@@ -467,10 +3444,23 @@ class IPLPY(izaber.plpython.base.IPLPY):
         """
         old = self.TD['old'] or {}
         new = self.TD['new'] or {}
+
+        # The trigger is on product_template so find its variants
+        data = self.qp('trigger_product_changes', """
+            SELECT  id
+            FROM    product_product
+            WHERE
+                    product_tmpl_id = ANY($1::int[])
+        """,["int[]"],[[
+            template_id
+            for template_id in [ old.get('id'), new.get('id') ]
+            if template_id
+        ]])
+
         dirty_product_ids = []
-        for product_id in [ old.get('id'), new.get('id') ]:
-            if not product_id: continue
-            dirty_product_ids.append(product_id)
+        for row in data:
+            dirty_product_ids.append(row['id'])
+        self.invalidate_checkpoints(dirty_product_ids)
         self.mark_products_dirty(dirty_product_ids)
 """
 
@@ -478,7 +3468,7 @@ CREATE OR REPLACE FUNCTION fn_uom_convert(from_uom_id integer,qty numeric,to_uom
 RETURNS NUMERIC AS
 $$
     from izaber.plpython.zerp import init_plpy
-    iplpy = init_plpy(globals(),reload=True)
+    iplpy = init_plpy(globals())
     return iplpy.uom_convert(from_uom_id,qty,to_uom_id)
 $$
 LANGUAGE plpython3u;
@@ -538,7 +3528,10 @@ DROP FUNCTION fn_get_cached_available_qty(product_id integer);
 CREATE OR REPLACE FUNCTION fn_get_cached_available_qty(product_id integer)
 RETURNS NUMERIC AS
 $$
-    return GD['product_counts'].get(product_id,{}).get('qty_available')
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    results = iplpy.get_cached_products_available([product_id])
+    return results.get(product_id,{}).get('qty_available')
 $$
 LANGUAGE plpython3u;
 
@@ -546,7 +3539,10 @@ DROP FUNCTION fn_get_cached_virtual_available(product_id integer);
 CREATE OR REPLACE FUNCTION fn_get_cached_virtual_available(product_id integer)
 RETURNS NUMERIC AS
 $$
-    return GD['product_counts'].get(product_id,{}).get('virtual_available')
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    results = iplpy.get_cached_products_available([product_id])
+    return results.get(product_id,{}).get('virtual_available')
 $$
 LANGUAGE plpython3u;
 
@@ -554,7 +3550,10 @@ DROP FUNCTION fn_get_cached_incoming_qty(product_id integer);
 CREATE OR REPLACE FUNCTION fn_get_cached_incoming_qty(product_id integer)
 RETURNS NUMERIC AS
 $$
-    return GD['product_counts'].get(product_id,{}).get('incoming_qty')
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    results = iplpy.get_cached_products_available([product_id])
+    return results.get(product_id,{}).get('incoming_qty')
 $$
 LANGUAGE plpython3u;
 
@@ -562,7 +3561,10 @@ DROP FUNCTION fn_get_cached_outgoing_qty(product_id integer);
 CREATE OR REPLACE FUNCTION fn_get_cached_outgoing_qty(product_id integer)
 RETURNS NUMERIC AS
 $$
-    return GD['product_counts'].get(product_id,{}).get('outgoing_qty')
+    from izaber.plpython.zerp import init_plpy
+    iplpy = init_plpy(globals())
+    results = iplpy.get_cached_products_available([product_id])
+    return results.get(product_id,{}).get('outgoing_qty')
 $$
 LANGUAGE plpython3u;
 
@@ -587,7 +3589,8 @@ LANGUAGE plpython3u;
 
 CREATE TRIGGER      trig_location_changes_updel
 BEFORE UPDATE OF    active,
-                    location_id,
+                    location_id
+    OR DELETE
 ON
                     stock_location
 FOR EACH ROW
@@ -645,22 +3648,28 @@ $$
 LANGUAGE plpython3u;
 
 
-CREATE OR REPLACE FUNCTION fn_zerp_plpy_install()
+DROP FUNCTION IF EXISTS fn_zerp_plpy_install();
+DROP FUNCTION IF EXISTS fn_zerp_plpy_install(text);
+DROP FUNCTION IF EXISTS fn_zerp_plpy_install(text, boolean);
+DROP FUNCTION IF EXISTS fn_zerp_plpy_install(text, boolean, boolean);
+DROP FUNCTION IF EXISTS fn_zerp_plpy_install(text, boolean, boolean, boolean);
+CREATE OR REPLACE FUNCTION fn_zerp_plpy_install(stock_move_trigger_mode text default null, keep_history boolean default null, notify_dirty boolean default null, coalesce_dirty boolean default null, location_matrix boolean default null)
 RETURNS TEXT AS
 $$
     from izaber.plpython.zerp import init_plpy
     iplpy = init_plpy(globals())
-    return iplpy.install()
+    return iplpy.install(stock_move_trigger_mode, keep_history, notify_dirty, coalesce_dirty, location_matrix)
 $$
 LANGUAGE plpython3u;
 
 
-CREATE OR REPLACE FUNCTION fn_zerp_plpy_vacuum()
+DROP FUNCTION IF EXISTS fn_zerp_plpy_vacuum();
+CREATE OR REPLACE FUNCTION fn_zerp_plpy_vacuum(batch_size integer default 10000, max_seconds float8 default 30, max_rows integer default null)
 RETURNS TEXT AS
 $$
     from izaber.plpython.zerp import init_plpy
     iplpy = init_plpy(globals())
-    return iplpy.vacuum()
+    return iplpy.vacuum(batch_size, max_seconds, max_rows)
 $$
 LANGUAGE plpython3u;
 
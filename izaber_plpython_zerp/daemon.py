@@ -0,0 +1,179 @@
+""" Out of band sync daemon
+
+    Listens for the product ids that mark_products_dirty announces on
+    NOTIFY_CHANNEL (install with notify_dirty=True) and recalculates them
+    shortly afterwards. Ids arriving within the debounce window are
+    merged so a burst of edits to one product only costs one recompute.
+
+    Run with:
+
+        python -m izaber.plpython.zerp.daemon --dsn "dbname=zerp"
+
+    Requires psycopg 3 (pip install izaber-plpython-zerp[daemon])
+"""
+
+import argparse
+import asyncio
+import logging
+
+from izaber.plpython.zerp.base import NOTIFY_CHANNEL
+
+log = logging.getLogger('izaber.plpython.zerp.daemon')
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_RECONNECT_DELAY = 5.0
+
+class SyncDaemon(object):
+
+    def __init__(self,
+                    dsn,
+                    channel=NOTIFY_CHANNEL,
+                    debounce=DEFAULT_DEBOUNCE,
+                    batch_size=DEFAULT_BATCH_SIZE,
+                    reconnect_delay=DEFAULT_RECONNECT_DELAY):
+        self.dsn = dsn
+        self.channel = channel
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.reconnect_delay = reconnect_delay
+        self.pending = set()
+        self.pending_event = asyncio.Event()
+        self.listening = asyncio.Event()
+
+    async def connect(self):
+        import psycopg
+        return await psycopg.AsyncConnection.connect(self.dsn, autocommit=True)
+
+    async def catch_up(self, conn):
+        """ Syncs whatever became dirty while we weren't listening. Each
+            worker call is its own transaction as we're in autocommit
+        """
+        synced = 0
+        while True:
+            cur = await conn.execute(
+                "SELECT fn_sync_product_product_summary_worker(%s)",
+                [self.batch_size]
+            )
+            count = (await cur.fetchone())[0]
+            if not count:
+                break
+            synced += count
+        if synced:
+            log.info("Caught up on %s product(s)", synced)
+
+    async def listen(self):
+        """ Collects the product ids from the notifications into pending
+        """
+        from psycopg import sql
+        conn = await self.connect()
+        try:
+            await conn.execute(
+                sql.SQL("LISTEN {}").format(sql.Identifier(self.channel))
+            )
+            log.info("Listening on %s", self.channel)
+            self.listening.set()
+            async for notify in conn.notifies():
+                for product_id in notify.payload.split(','):
+                    if product_id:
+                        self.pending.add(int(product_id))
+                self.pending_event.set()
+        finally:
+            await conn.close()
+
+    async def sync(self):
+        """ Waits for ids to show up, lets more accumulate for the
+            debounce window then syncs them all in batches
+        """
+        conn = await self.connect()
+        try:
+            # Anything dirtied before the LISTEN took effect won't be
+            # announced again so the catch up has to come after it
+            await self.listening.wait()
+            await self.catch_up(conn)
+            while True:
+                await self.pending_event.wait()
+                await asyncio.sleep(self.debounce)
+                self.pending_event.clear()
+
+                product_ids = sorted(self.pending)
+                self.pending.clear()
+                for i in range(0, len(product_ids), self.batch_size):
+                    batch = product_ids[i:i+self.batch_size]
+                    await conn.execute(
+                        "SELECT fn_sync_product_product_summary(%s::int[])",
+                        [batch]
+                    )
+                log.debug("Synced %s product(s)", len(product_ids))
+        finally:
+            await conn.close()
+
+    async def run(self):
+        """ Runs until cancelled, reconnecting whenever the database
+            goes away
+        """
+        while True:
+            tasks = [
+                asyncio.ensure_future(self.listen()),
+                asyncio.ensure_future(self.sync()),
+            ]
+            try:
+                done, running = await asyncio.wait(
+                                    tasks,
+                                    return_when=asyncio.FIRST_EXCEPTION
+                                )
+                for task in done:
+                    task.result()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                log.warning(
+                    "Sync daemon failed (%s), reconnecting in %ss",
+                    ex, self.reconnect_delay
+                )
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            # The catch up on reconnect covers anything we missed
+            self.pending.clear()
+            self.pending_event.clear()
+            self.listening.clear()
+            await asyncio.sleep(self.reconnect_delay)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Keeps Zerp cached product quantities in sync'
+            )
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the Zerp database')
+    parser.add_argument('--channel', default=NOTIFY_CHANNEL,
+                        help='NOTIFY channel to listen on')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help='seconds to gather ids before syncing them')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='products to sync per statement')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=args.verbose and logging.DEBUG or logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s'
+    )
+
+    async def run():
+        daemon = SyncDaemon(
+                    args.dsn,
+                    channel=args.channel,
+                    debounce=args.debounce,
+                    batch_size=args.batch_size,
+                )
+        await daemon.run()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+""" Multi process sync of the dirty product quantities
+
+    Runs the same sync code as the database functions but from a pool of
+    processes outside of it, each connected through the plpy adapter (see
+    izaber.plpython.zerp.adapter). The product id space is split into as
+    many shards as there are workers (by product_id modulo the number of
+    workers) so that the workers never contend over the same products.
+
+    Run with:
+
+        python -m izaber.plpython.zerp.sync_client --dsn "dbname=zerp" --workers 4
+
+    Requires psycopg 3 (pip install izaber-plpython-zerp[daemon])
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import time
+
+log = logging.getLogger('izaber.plpython.zerp.sync_client')
+
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 500
+
+def sync_shard(dsn, shards, shard, batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """ Syncs the dirty products of one shard, committing after every
+        batch. Returns the number of products synced
+    """
+    import psycopg
+    from izaber.plpython.zerp.adapter import connect_iplpy
+
+    with psycopg.connect(dsn) as conn:
+        iplpy = connect_iplpy(conn)
+        return iplpy.run_sync_product_product_summary_worker(
+                    batch_size,
+                    max_batches,
+                    shards,
+                    shard
+                )
+
+def sync(dsn, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """ Syncs every dirty product using one process per shard. Returns
+        the number of products synced
+    """
+    start = time.monotonic()
+    synced = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(sync_shard, dsn, workers, shard, batch_size, max_batches)
+            for shard in range(workers)
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            synced += future.result()
+    log.info(
+        "Synced %s product(s) in %.1fs with %s worker(s)",
+        synced, time.monotonic() - start, workers
+    )
+    return synced
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+                description='Syncs Zerp cached product quantities from a pool of processes'
+            )
+    parser.add_argument('--dsn', required=True,
+                        help='libpq connection string of the Zerp database')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='processes to spread the products over')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='products to sync per transaction')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='batches per worker before stopping')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=args.verbose and logging.DEBUG or logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s'
+    )
+
+    sync(
+        args.dsn,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_batches=args.max_batches,
+    )
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,9 @@ setup(name='izaber_plpython_zerp',
           'izaber',
           'izaber-plpython',
       ],
+      extras_require={
+          'daemon': ['psycopg>=3'],
+      },
       dependency_links=[],
       zip_safe=False)
 